@@ -0,0 +1,219 @@
+import asyncio
+import json
+import time
+from datetime import datetime
+from typing import List
+
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException
+
+from _documents.users.service import user_service as users
+from _services.redis.service import RedisClient
+from config.settings import SEARCH_TOKEN_LENGTH
+from config.conftest import *
+from utils.helper import get_instance
+from utils.logger import logger
+
+
+@pytest.mark.asyncio
+async def test_raw_read_benchmark(user_documents):
+    docs = user_documents()
+
+    start = time.perf_counter()
+    model_rows = [json.loads(get_instance(users.config.py_list_class, x).json()) for x in docs]
+    model_time = time.perf_counter() - start
+
+    projection = users.raw_projection()
+    start = time.perf_counter()
+    raw_rows = [users.transform_raw({k: v for k, v in x.items() if k in projection}) for x in docs]
+    raw_time = time.perf_counter() - start
+
+    assert raw_rows == model_rows
+    logger.info(
+        f"[Benchmark] {len(docs)} users, model: {model_time / len(docs) * 1e6:.1f} us/row, "
+        f"raw: {raw_time / len(docs) * 1e6:.1f} us/row ({model_time / raw_time:.1f}x)"
+    )
+
+
+def count_reads(monkeypatch, service) -> list:
+    """
+    > Record the queries of the database reads made by the cache misses of the service
+    """
+    reads = []
+    find_many = service.find_many
+    async def counted(query, *args, **kwargs):
+        reads.append(query)
+        return await find_many(query, *args, **kwargs)
+    monkeypatch.setattr(service, 'find_many', counted)
+    return reads
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('layout', ['hash', 'string'])
+async def test_cache_tombstones(layout: str, user_documents, monkeypatch):
+    monkeypatch.setattr(users.config, 'cache_layout', layout)
+    doc = user_documents(1)[0]
+    reads = count_reads(monkeypatch, users)
+    try:
+        await tombstones(doc, reads)
+    finally:
+        await users.db_client().delete_one({'_id': doc['_id']})
+        await users.cache_delete([doc['_id']])
+
+
+async def tombstones(doc: dict, reads: list):
+    # an unknown id is read once, then answered by its tombstone
+    assert await users.cache_lookup(doc['_id']) is None
+    assert await users.cache_lookup(doc['_id']) is None
+    assert len(reads) == 1
+
+    # the record written replaces the tombstone
+    await users.db_client().insert_one(doc)
+    await users.cache_update(users.transform_list(doc))
+    assert (await users.cache_lookup(doc['_id'])).email == doc['email']
+
+    # a read started before the delete and cached after it does not bring the record back
+    stale = await users.find_many({'_id': doc['_id']})
+    await users.delete_many([str(doc['_id'])])
+    await users.cache_fill(stale, [])
+    reads.clear()
+    assert await users.cache_lookup(doc['_id']) is None
+    assert len(reads) == 0
+
+    # a read cached after an update keeps the updated record
+    await users.db_client().insert_one(doc)
+    await users.cache_delete([doc['_id']])
+    stale = await users.find_many({'_id': doc['_id']})
+    await users.cache_update(users.transform_list({**doc, 'name': 'Updated'}))
+    await users.cache_fill(stale, [])
+    assert (await users.cache_lookup(doc['_id'])).name == 'Updated'
+
+
+@pytest.mark.asyncio
+async def test_cache_single_flight(user_documents, monkeypatch):
+    doc = user_documents(1)[0]
+    await users.db_client().insert_one(doc)
+    reads = count_reads(monkeypatch, users)
+    try:
+        # without the Redis lock, only the futures of the process coalesce the reads
+        monkeypatch.setattr(users.config, 'cache_lock', False)
+        await single_flight(doc, reads)
+        monkeypatch.setattr(users.config, 'cache_lock', True)
+        await lock_polling(doc, reads)
+    finally:
+        await users.db_client().delete_one({'_id': doc['_id']})
+        await users.cache_delete([doc['_id']])
+
+
+async def single_flight(doc: dict, reads: list):
+    # concurrent misses of the same id in the process share a single read
+    await users.cache_delete([doc['_id']])
+    items = await asyncio.gather(*[users.cache_lookup(doc['_id']) for _ in range(20)])
+    assert len(reads) == 1
+    assert all(x.email == doc['email'] for x in items)
+    # the waiters get their own copy of the record
+    assert len({id(x) for x in items}) == len(items)
+    assert len(users.cache_inflight) == 0
+
+
+async def lock_polling(doc: dict, reads: list):
+    lock, token = f"_lock:{users.cache_key(doc['_id'])}", 'other-worker'
+
+    # another worker holds the lock and caches the record, the lookup waits for it
+    await users.cache_delete([doc['_id']])
+    reads.clear()
+    assert len(await RedisClient().acquire_locks([lock], token, 5000)) == 1
+    lookup = asyncio.create_task(users.cache_lookup(doc['_id']))
+    await asyncio.sleep(0.2)
+    assert not lookup.done()
+    await users.cache_fill([users.transform_list(doc)], [])
+    await RedisClient().release_locks([lock], token)
+    assert (await lookup).email == doc['email']
+    assert len(reads) == 0
+
+    # the lock is released without the record, the lookup reads it itself
+    await users.cache_delete([doc['_id']])
+    assert len(await RedisClient().acquire_locks([lock], token, 5000)) == 1
+    lookup = asyncio.create_task(users.cache_lookup(doc['_id']))
+    await asyncio.sleep(0.2)
+    await RedisClient().release_locks([lock], token)
+    assert (await lookup).email == doc['email']
+    assert len(reads) == 1
+
+
+def test_cursor_query():
+    doc = {'_id': ObjectId(), 'created_at': datetime(2023, 1, 2, 3, 4, 5, 678000)}
+    cursor = users.encode_cursor(doc)
+    query = users.cursor_query({'status': 'active'}, cursor)
+    assert query == {'$and': [{'status': 'active'}, {'$or': [
+        {'created_at': {'$lt': doc['created_at']}},
+        {'created_at': doc['created_at'], '_id': {'$lt': doc['_id']}}
+    ]}]}
+    # on another date field
+    assert users.cursor_query({}, users.encode_cursor({**doc, 'timestamp': doc['created_at']}, 'timestamp'), 'timestamp') == {
+        '$and': [{}, {'$or': [
+            {'timestamp': {'$lt': doc['created_at']}},
+            {'timestamp': doc['created_at'], '_id': {'$lt': doc['_id']}}
+        ]}]
+    }
+    # the first page, and the cursors not made by `encode_cursor`
+    assert users.cursor_query({'status': 'active'}, '') == {'status': 'active'}
+    for cursor in ['not a cursor', 'WyIyMDIzIiwgIngiXQ==']:
+        with pytest.raises(HTTPException) as e:
+            users.cursor_query({}, cursor)
+        assert e.value.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_cursor_pages(user_documents):
+    docs = user_documents(7)
+    # the same created_at on several documents, the pages are cut between them by _id
+    for i, x in enumerate(docs): x['created_at'] = datetime(2023, 1, 1 + i // 3)
+    await users.db_client().insert_many(docs)
+    try:
+        await cursor_pages(docs)
+    finally:
+        await users.db_client().delete_many({'_id': {'$in': [x['_id'] for x in docs]}})
+
+
+async def cursor_pages(docs: List[dict]):
+    expected = [str(x['_id']) for x in sorted(docs, key=lambda x: (x['created_at'], x['_id']), reverse=True)]
+    query = {'_id': {'$in': [x['_id'] for x in docs]}}
+
+    pages, cursor = [], ''
+    while cursor is not None:
+        out = await users.fetch(limit=3, cursor=cursor, raw=True, query=query)
+        pages.append([x['id'] for x in out['data']])
+        cursor = out['next_cursor']
+    assert [len(x) for x in pages] == [3, 3, 1]
+    assert [x for page in pages for x in page] == expected
+
+    # a full last page is followed by an empty one
+    pages, cursor = [], ''
+    query = {'_id': {'$in': [ObjectId(x) for x in expected[:6]]}}
+    while cursor is not None:
+        out = await users.fetch(limit=3, cursor=cursor, raw=True, query=query)
+        pages.append([x['id'] for x in out['data']])
+        cursor = out['next_cursor']
+    assert pages == [expected[:3], expected[3:6], []]
+
+
+def test_search_tokens():
+    assert users.search_tokens('Jo, Doe') == ['d', 'do', 'doe', 'j', 'jo']
+    assert users.search_tokens('Jo, Doe', prefixes=False) == ['doe', 'jo']
+    assert users.search_tokens(['Ab', None, 3]) == ['3', 'a', 'ab']
+    assert users.search_tokens(None) == []
+    # the words are cut at SEARCH_TOKEN_LENGTH
+    assert max(len(x) for x in users.search_tokens('x' * 50)) == SEARCH_TOKEN_LENGTH
+
+    doc = {'email': 'jo.doe@x.io', 'name': 'Jo', 'display_name': None}
+    assert users.search_values(doc) == {
+        users.search_key('email'): users.search_tokens(doc['email']),
+        users.search_key('name'): ['j', 'jo'],
+        users.search_key('display_name'): [],
+    }
+    # the updates only tokenize the fields they set
+    assert list(users.search_values({'name': 'Al'}, partial=True)) == [users.search_key('name')]
+    assert users.search_document(doc)['_search'] == {**users.search_values(doc), '_v': users.search_version()}
+    assert len(users.search_version()) == 8
@@ -2,6 +2,7 @@ from datetime import datetime, timedelta
 from typing import Any, List
 
 from _services.mongo.client import MongoDbClient
+from config.settings import CACHE_TTL, CACHE_TTL_JITTER
 
 from utils.schema import BaseConfig, PyObjectId
 from pydantic import BaseModel, Field
@@ -14,6 +15,13 @@ class ServiceBaseConfig(BaseModel):
     py_create_class: Any
     py_master_class: Any
     py_update_class: Any
+    indexes: List[Any] = Field([]) # pymongo IndexModel, reconciled by BaseService.sync_indexes
+    search_fields: List[str] = Field([]) # fields tokenized into the `_search` index on write
+    local_cache: bool = False # keep parsed records in the per-process cache in front of Redis
+    cache_ttl: int | None = Field(CACHE_TTL) # seconds before a cached record expires, None keeps it
+    cache_ttl_jitter: float = Field(CACHE_TTL_JITTER) # random extra fraction of the TTL, spreads expiries
+    cache_layout: str = 'string' # `hash` stores one field per attribute, lookups can read a subset
+    cache_lock: bool = False # coalesce the database reads of cache misses across workers with a Redis lock
     
     mongodb_client: MongoDbClient | None
 
@@ -1,16 +1,68 @@
+import asyncio
+import base64
+import functools
+import hashlib
 import json
-from typing import Any, List
+import re
+import time
+import uuid
+from typing import Any, AsyncIterator, Callable, Dict, List, Set, Tuple
 
 from bson import ObjectId
 from fastapi import HTTPException
 from pydantic import BaseModel
-from pymongo import UpdateOne
+from pymongo import IndexModel, ReturnDocument, UpdateOne
 
 from _documents._base.schema import *
 from _documents.users.schema import UserList
-from _services.redis.service import RedisClient
-from config.settings import MAX_FETCH_LIMIT, MAX_QUERY_LENGTH
+from _services.redis.service import RedisClient, local_cache
+from config.settings import (CACHE_LOCK_POLL_MS, CACHE_LOCK_TIMEOUT_MS,
+                             CACHE_VERSION, COUNT_CACHE_TTL, ITER_BATCH_SIZE, MAX_FETCH_LIMIT,
+                             MAX_QUERY_LENGTH, MEMOIZE_TAG_TTL, MEMOIZE_TTL, NEGATIVE_CACHE_TTL,
+                             SEARCH_REINDEX_LOCK_MS, SEARCH_TOKEN_LENGTH, SEARCH_VERSION)
 from utils.helper import get_instance
+from utils.logger import logger
+from utils.schema import encode_json
+
+CURSOR_SORT = [('created_at', -1), ('_id', -1)]
+
+# Field marking the cache entry of an id missing from the database
+TOMBSTONE_FIELD = '_tombstone'
+
+# Tag of every memoized result of a document, invalidated by the writes of `BaseService`
+ALL_TAG = '*'
+
+
+def memoize(tags: Callable[..., List[str]] | None = None, ttl: int = MEMOIZE_TTL):
+    """
+    > Cache the results of a service method in Redis, keyed by a stable hash of the method name and
+    its arguments, e.g. the pipeline of `find_aggregate_memo`. A result is kept until the TTL, or
+    until `post_write` invalidates one of its tags or the whole document. The result is returned as
+    decoded from the cache on every call, the first one included: with the JSON codec, ObjectIds
+    come back as strings and datetimes as timestamps. The generation of each tag is its own key,
+    renewed for `MEMOIZE_TAG_TTL` on every invalidation, so the tags of the records no longer
+    written expire
+    
+    :param tags: Return the tags of a call from the arguments of the method
+    :param ttl: The TTL of the results in seconds, at most `MEMOIZE_TAG_TTL`
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self: 'BaseService', *args, **kwargs):
+            call_tags = [ALL_TAG, *(tags(self, *args, **kwargs) if tags is not None else [])]
+            generations = await RedisClient().get_counters([f'_memo:{self.config.document}:tag:{x}' for x in call_tags])
+            key = f'_memo:{self.config.document}:' + hashlib.md5(json.dumps(
+                [func.__qualname__, args, kwargs, call_tags, generations], sort_keys=True, default=str
+            ).encode()).hexdigest()
+            if (cached := await RedisClient().get_cache(key)) is not None:
+                return cached
+            result = await func(self, *args, **kwargs)
+            payload = RedisClient().codec.encode(result if RedisClient().codec.native_types else encode_json(result))
+            await RedisClient().set_cache_raw(payload, key, ex=min(ttl, MEMOIZE_TAG_TTL))
+            # The same values as the calls reading it from the cache
+            return RedisClient().serialize_values(payload)
+        return wrapper
+    return decorator
 
 
 class BaseService():
@@ -23,6 +75,9 @@ class BaseService():
         :type config: ServiceBaseConfig
         """
         self.config = config
+        self.cache_stats = {'hits': 0, 'misses': 0, 'tombstones': 0}
+        self.cache_inflight: Dict[ObjectId, asyncio.Future] = {}
+        self.cache_namespace = self.schema_hash()
 
 
     def db_client(self):
@@ -57,6 +112,32 @@ class BaseService():
         return get_instance(self.config.py_master_class, item)
 
 
+    def raw_projection(self) -> dict:
+        """
+        > The projection of the fields of `py_list_class`, used by the raw read mode
+        
+        :return: A projection dictionary
+        """
+        return {x.alias: 1 for x in self.config.py_list_class.__fields__.values()}
+
+
+    def transform_raw(self, item: dict, model: type[BaseModel] | None = None) -> dict:
+        """
+        > Encode a trusted database document straight to the JSON-ready dictionary of a model,
+        without building and validating the model. Missing fields take their default value
+        
+        :param item: The database document
+        :type item: dict
+        :param model: The model of the document, `py_list_class` by default
+        :type model: type[BaseModel] | None
+        :return: The same dictionary as `json.loads(model(**item).json())`
+        """
+        return {
+            name: encode_json(item[x.alias] if x.alias in item else x.get_default())
+            for name, x in (model or self.config.py_list_class).__fields__.items()
+        }
+
+
     async def build_record(self, data: BaseModel | List[BaseModel], user: UserList | None  = None) -> BaseModel | List[BaseModel]:
         """
         It takes a list of data and a user, and returns a list of data
@@ -72,6 +153,50 @@ class BaseService():
         return data if not is_single else data[0]
 
 
+    async def sync_indexes(self):
+        """
+        > Reconcile the indexes declared in `config.indexes` with the collection, see
+        `sync_collection_indexes`
+        """
+        await self.sync_collection_indexes(self.db_client(), self.config.indexes + self.search_indexes())
+
+
+    async def sync_collection_indexes(self, collection, indexes: List[IndexModel]):
+        """
+        > Create the missing indexes, one at a time so an index failing to build does not hold up the
+        others. A changed `expireAfterSeconds` is updated in place with `collMod`. The indexes whose
+        keys or other options changed are only reported: dropping and rebuilding them is left to a
+        migration, as the collection would have no index while it is rebuilt
+        """
+        existing: dict = await collection.index_information()
+        declared = {x.document['name']: x for x in indexes}
+        options = ['unique', 'sparse', 'partialFilterExpression']
+        to_create = []
+        for name, index in declared.items():
+            if (current := existing.get(name)) is None:
+                to_create.append(index)
+                continue
+            ttl, current_ttl = index.document.get('expireAfterSeconds'), current.get('expireAfterSeconds')
+            if list(index.document['key'].items()) != [tuple(x) for x in current['key']] or any(
+                index.document.get(k, False) != current.get(k, False) for k in options
+            ) or (ttl is None) != (current_ttl is None):
+                logger.warning(f"[Index] {collection.name}.{name} differs from its declaration, rebuild it with a migration")
+            elif ttl != current_ttl:
+                logger.info(f"[Index] Set the TTL of {collection.name}.{name} to {ttl}s")
+                await collection.database.command('collMod', collection.name, index={
+                    'name': name, 'expireAfterSeconds': ttl
+                })
+        if len(to_create) > 0:
+            logger.info(f"[Index] Create {collection.name}.{[x.document['name'] for x in to_create]}")
+        for index in to_create:
+            try:
+                await collection.create_indexes([index])
+            except Exception as e:
+                logger.error(f"[Index] Unable to create {collection.name}.{index.document['name']}: {e}")
+        if len(undeclared := set(existing) - set(declared) - {'_id_'}) > 0:
+            logger.warning(f"[Index] Undeclared indexes on {collection.name}: {sorted(undeclared)}")
+
+
     async def validate_ids(self, ids: List[str]):
         """
         This function validates a list of IDs by checking if they exist in a database and raises a
@@ -149,11 +274,11 @@ class BaseService():
         """
         if (item := await self.find(query, select, sort)) is not None:
             piped: BaseModel = await self.build_record(item, user)
-            return json.loads(piped.json())
+            return encode_json(piped.dict())
         return None
     
 
-    async def find_many(self, query, select=None, sort=None, limit=None, skip=None) -> List[BaseList]:
+    async def find_many(self, query, select=None, sort=None, limit=None, skip=None, cursor=None) -> List[BaseList]:
         """
         It takes a query, and returns a list of BaseList objects
         
@@ -162,15 +287,20 @@ class BaseService():
         :param sort: A list of (key, direction) pairs specifying the sort order for this query
         :param limit: The maximum number of documents to return
         :param skip: The number of documents to skip
+        :param cursor: A cursor from `encode_cursor`, the documents are then sorted by `(created_at, _id)`
+        descending and start right after the cursor. Use an empty string for the first page
         :return: A list of BaseList objects
         """
         items: List[BaseModel] = []
-        cursor = self.db_client().find(query)
-        if select is not None: cursor = self.db_client().find(query, select)
-        if sort is not None: cursor = cursor.sort(sort)
-        if limit is not None: cursor = cursor.limit(limit)
-        if skip is not None: cursor = cursor.skip(skip)
-        for doc in await cursor.to_list(length=MAX_QUERY_LENGTH):
+        if cursor is not None:
+            query = self.cursor_query(query, cursor)
+            sort = CURSOR_SORT
+        db_cursor = self.db_client().find(query)
+        if select is not None: db_cursor = self.db_client().find(query, select)
+        if sort is not None: db_cursor = db_cursor.sort(sort)
+        if limit is not None: db_cursor = db_cursor.limit(limit)
+        if skip is not None: db_cursor = db_cursor.skip(skip)
+        for doc in await db_cursor.to_list(length=MAX_QUERY_LENGTH):
             items.append(self.transform_list(doc))
         return items
     
@@ -191,9 +321,31 @@ class BaseService():
         """
         items = await self.find_many(query, select, sort, limit, skip)
         piped_items: List[BaseModel] = await self.build_record(items, user)
-        return [json.loads(x.json()) for x in piped_items]
+        return [encode_json(x.dict()) for x in piped_items]
 
     
+    async def find_raw(self, query, sort=None, limit=None, skip=None, cursor=None) -> List[dict]:
+        """
+        > Like `find_build_many`, but the documents are encoded with `transform_raw`, skipping the
+        model validation and `build_record`. Use it for trusted data that needs no view piping
+        
+        :param query: The query to find the documents
+        :param sort: A list of (key, direction) pairs specifying the sort order for this query
+        :param limit: The maximum number of documents to return
+        :param skip: The number of documents to skip
+        :param cursor: A cursor from `encode_cursor`, see `find_many`
+        :return: A list of JSON object
+        """
+        if cursor is not None:
+            query = self.cursor_query(query, cursor)
+            sort = CURSOR_SORT
+        db_cursor = self.db_client().find(query, self.raw_projection())
+        if sort is not None: db_cursor = db_cursor.sort(sort)
+        if limit is not None: db_cursor = db_cursor.limit(limit)
+        if skip is not None: db_cursor = db_cursor.skip(skip)
+        return [self.transform_raw(doc) for doc in await db_cursor.to_list(length=MAX_QUERY_LENGTH)]
+
+
     async def find_aggregate(self, query: List[Any]) -> List[Any]:
         """
         It takes a query, runs it, and returns the results
@@ -208,44 +360,369 @@ class BaseService():
         return results
     
 
+    @memoize(tags=lambda self, query, tags: tags)
+    async def find_aggregate_memo(self, query: List[Any], tags: List[str]) -> List[Any]:
+        """
+        > `find_aggregate` with its results memoized in Redis, keyed by a hash of the pipeline
+        
+        :param query: The aggregation pipeline
+        :param tags: The tags invalidating the results, see `post_write`
+        :return: A list of documents
+        """
+        return await self.find_aggregate(query)
+
+
+    async def iter_many(self, query, select=None, sort=None, batch_size=ITER_BATCH_SIZE) -> AsyncIterator[List[BaseList]]:
+        """
+        > Stream the documents matching the query in batches, only one batch is held in memory and the
+        result is not truncated at `MAX_QUERY_LENGTH`
+        
+        :param query: The query to find the documents
+        :param select: A list of fields to include or exclude
+        :param sort: A list of (key, direction) pairs specifying the sort order for this query
+        :param batch_size: The number of records in each batch
+        :return: An async iterator of lists of BaseList objects
+        """
+        cursor = self.db_client().find(query, select) if select is not None else self.db_client().find(query)
+        if sort is not None: cursor = cursor.sort(sort)
+        batch: List[BaseList] = []
+        async for doc in cursor.batch_size(batch_size):
+            batch.append(self.transform_list(doc))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0: yield batch
+
+
+    async def iter_aggregate(self, query: List[Any], batch_size=ITER_BATCH_SIZE) -> AsyncIterator[List[Any]]:
+        """
+        > Stream the results of an aggregation in batches
+        
+        :param query: The pipeline to be executed
+        :type query: List[Any]
+        :param batch_size: The number of documents in each batch
+        :return: An async iterator of lists of documents
+        """
+        batch = []
+        async for doc in self.db_client().aggregate(query, batchSize=batch_size):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0: yield batch
+
+
+    async def iter_ids(self, query, batch_size=ITER_BATCH_SIZE) -> AsyncIterator[List[ObjectId]]:
+        """
+        > Stream the ids of the documents matching the query in batches, without building records
+        
+        :param query: The query to find the documents
+        :param batch_size: The number of ids in each batch
+        :return: An async iterator of lists of ObjectId
+        """
+        async for batch in self.iter_aggregate([
+            {'$match': query}, {'$project': {'_id': 1}}
+        ], batch_size):
+            yield [x['_id'] for x in batch]
+
+
     async def find_ids(self, **kwargs) -> List[ObjectId]:
         kwargs['select'] = {'_id': 1}
         return [x.id for x in await self.find_many(**kwargs)]
 
 
-    async def fetch(self, limit=None, skip=0, **kwargs):
+    async def count(self, query: dict | None = None, mode: str = 'exact') -> int:
+        """
+        > Count the documents matching the query
+        
+        :param query: The query to count the documents
+        :type query: dict | None
+        :param mode: `exact` runs `count_documents`, `cached` keeps the exact count in Redis for
+        `COUNT_CACHE_TTL` seconds or until the next write, `estimated` reads the collection metadata
+        for the empty query and falls back to `cached` otherwise
+        :type mode: str
+        :return: The number of documents
+        """
+        query = query or {}
+        if mode == 'estimated' and len(query) == 0:
+            return await self.db_client().estimated_document_count()
+        if mode not in ['cached', 'estimated']:
+            return await self.db_client().count_documents(query)
+
+        key = f'_count:{self.config.document}'
+        field = hashlib.md5(json.dumps(query, sort_keys=True, default=str).encode()).hexdigest()
+        now = datetime.utcnow().timestamp()
+        if (cached := await RedisClient().get_field(key, field)) is not None and cached[1] > now:
+            return cached[0]
+        count = await self.db_client().count_documents(query)
+        await RedisClient().set_field(key, field, [count, now + COUNT_CACHE_TTL], ex=COUNT_CACHE_TTL)
+        return count
+
+
+    @staticmethod
+    def encode_cursor(doc: dict, field: str = 'created_at') -> str:
+        """
+        > Encode the `(created_at, _id)` of the last document of a page into an opaque cursor
+        
+        :param doc: The raw document, it must contain `created_at` and `_id`
+        :type doc: dict
+        :param field: The date field the pages are sorted by, instead of `created_at`
+        :type field: str
+        :return: The cursor
+        """
+        return base64.urlsafe_b64encode(json.dumps(
+            [doc[field].isoformat(), str(doc['_id'])]
+        ).encode()).decode()
+
+
+    @staticmethod
+    def cursor_query(query: dict, cursor: str, field: str = 'created_at') -> dict:
+        """
+        > Add the range predicate of a cursor from `encode_cursor` to a query
+        
+        :param query: The query to restrict
+        :type query: dict
+        :param cursor: The cursor, an empty string returns the query as is
+        :type cursor: str
+        :param field: The date field the cursor was encoded with
+        :type field: str
+        :return: The query restricted to the documents after the cursor
+        """
+        if not cursor: return query
+        try:
+            created_at, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            created_at, id = datetime.fromisoformat(created_at), ObjectId(id)
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid cursor.")
+        return {
+            '$and': [query, {'$or': [
+                {field: {'$lt': created_at}},
+                {field: created_at, '_id': {'$lt': id}}
+            ]}]
+        }
+
+
+    async def find_page(self, query, select, sort=None, limit=MAX_FETCH_LIMIT, skip=0, cursor=None) -> List[dict]:
+        """
+        > Find the raw documents of a page, by `skip` or by `cursor`
+        
+        :param query: The query to find the documents
+        :param select: The projection of the documents, `created_at` is added in cursor mode
+        :param sort: A list of (key, direction) pairs, ignored in cursor mode
+        :param limit: The page size
+        :param skip: The number of documents to skip, ignored in cursor mode
+        :param cursor: A cursor from `encode_cursor`, see `find_many`
+        :return: A list of documents
+        """
+        if cursor is not None:
+            return await self.db_client().find(
+                self.cursor_query(query, cursor), {**select, 'created_at': 1}
+            ).sort(CURSOR_SORT).limit(limit).to_list(length=limit)
+        return await self.db_client().find(query, select).sort(
+            sort or [('created_at', -1)]
+        ).skip(skip).limit(limit).to_list(length=limit)
+
+
+    async def fetch(self, limit=None, skip=0, count_mode='exact', cursor=None, raw=False, **kwargs):
+        """
+        > Fetch a page of records, the page and the total count are queried concurrently
+        
+        :param limit: The maximum number of records to return
+        :param skip: The number of records to skip, ignored when `cursor` is set
+        :param count_mode: The `mode` passed to `count`
+        :param cursor: The `next_cursor` of the previous page, or an empty string for the first page.
+        The records are then sorted by `(created_at, _id)` descending and paginated by range instead
+        of `skip`
+        :param raw: Read the records straight from the database with `transform_raw`, bypassing the
+        cache and `build_record`
+        :return: A dictionary with the data, the count, the page and the cursor of the next page
+        """
         limit = int(limit) if limit is not None else MAX_FETCH_LIMIT
-        ids = await self.find_ids(
-            query=kwargs.get('query') or {}, 
-            select={'_id': 1}, 
-            sort=kwargs.get('sort') or [('created_at', -1)], 
-            limit=limit, skip=skip
+        query = kwargs.get('query') or {}
+        docs, count = await asyncio.gather(
+            self.find_page(
+                query, self.raw_projection() if raw else {'_id': 1},
+                kwargs.get('sort'), limit, skip, cursor
+            ),
+            self.count(query, count_mode)
         )
-        items = await self.cache_lookup(ids)
-        items = await self.build_record(items)
-        page = int(skip / limit) + 1
+        if raw:
+            data = [self.transform_raw(x) for x in docs]
+        else:
+            items = await self.cache_lookup([x['_id'] for x in docs])
+            data = [encode_json(x.dict()) for x in await self.build_record(items)]
 
         return {
-            'data': [json.loads(x.json()) for x in items],
-            'count': await self.db_client().count_documents(kwargs.get('query') or {}),
-            'page': page
+            'data': data,
+            'count': count,
+            'page': int(skip / limit) + 1 if cursor is None else None,
+            'next_cursor': self.encode_cursor(docs[-1]) if cursor is not None and len(docs) == limit else None
         }
     
 
-    async def search(self, keywords: List[SearchKeyword], skip = 0):
+    # Search
+    @staticmethod
+    def search_key(field: str) -> str:
+        return field.replace('.', '_')
+
+
+    @staticmethod
+    def search_tokens(value: Any, prefixes: bool = True) -> List[str]:
+        """
+        > Split a value into lowercase words, and their prefixes when `prefixes` is set. Words are cut
+        at `SEARCH_TOKEN_LENGTH` characters
+        
+        :param value: The value to tokenize, lists are tokenized item by item
+        :param prefixes: Whether to add the prefixes of every word
+        :return: A sorted list of tokens
+        """
+        if value is None: return []
+        if isinstance(value, list): value = ' '.join(str(x) for x in value if x is not None)
+        tokens = set()
+        for word in re.findall(r'\w+', str(value).lower()):
+            word = word[:SEARCH_TOKEN_LENGTH]
+            if prefixes: tokens.update(word[:i] for i in range(1, len(word) + 1))
+            else: tokens.add(word)
+        return sorted(tokens)
+
+
+    def search_values(self, data: dict, partial: bool = False) -> dict:
+        """
+        > The search tokens of the `search_fields`, by search key
+        
+        :param data: A document or the `$set` of an update
+        :type data: dict
+        :param partial: Only tokenize the fields present in `data`, for updates
+        :type partial: bool
+        :return: A dictionary of token lists
+        """
+        values = {}
+        for field in self.config.search_fields:
+            path = field.split('.')
+            if partial and path[0] not in data: continue
+            value = data
+            for key in path: value = value.get(key) if isinstance(value, dict) else None
+            values[self.search_key(field)] = self.search_tokens(value)
+        return values
+
+
+    def search_document(self, doc: dict) -> dict:
+        """
+        > Add the `_search` tokens to a document before it is inserted
+        
+        :param doc: The document to insert
+        :type doc: dict
+        :return: A copy of the document with its search tokens
+        """
+        if len(self.config.search_fields) == 0: return doc
+        return {**doc, '_search': {**self.search_values(doc), '_v': self.search_version()}}
+
+
+    def search_version(self) -> str:
+        """
+        > A short hash of the `search_fields` and the tokenizer settings, kept in `_search._v` by the
+        writes tokenizing every field. The documents with another version are reindexed
+        
+        :return: An 8 characters hex digest
+        """
+        return hashlib.md5(
+            json.dumps([SEARCH_VERSION, SEARCH_TOKEN_LENGTH, self.config.search_fields]).encode()
+        ).hexdigest()[:8]
+
+
+    def search_indexes(self) -> List[IndexModel]:
+        if len(self.config.search_fields) == 0: return []
+        return [
+            IndexModel(f'_search.{self.search_key(x)}', name=f'_search.{self.search_key(x)}')
+            for x in self.config.search_fields
+        ] + [IndexModel('_search._v', name='_search._v')]
+
+
+    async def reindex_search(self, batch_size=ITER_BATCH_SIZE) -> int:
+        """
+        > Write the search tokens of the documents whose `_search` is missing or has another
+        `search_version`, found through the `_search._v` index. Run by the cron, a Redis lock keeps
+        the other processes out
+        
+        :param batch_size: The number of documents updated per bulk write
+        :return: The number of reindexed documents
+        """
+        if len(self.config.search_fields) == 0: return 0
+        token, lock = uuid.uuid4().hex, f'_lock:_search:{self.config.document}'
+        if len(await RedisClient().acquire_locks([lock], token, SEARCH_REINDEX_LOCK_MS)) == 0: return 0
+        version, reindexed = self.search_version(), 0
+        try:
+            async for docs in self.iter_aggregate([
+                {'$match': {'_search._v': {'$ne': version}}},
+                {'$project': {x.split('.')[0]: 1 for x in self.config.search_fields}}
+            ], batch_size):
+                await self.db_client().bulk_write([
+                    UpdateOne({'_id': x['_id']}, {'$set': {
+                        '_search': {**self.search_values(x), '_v': version}
+                    }}) for x in docs
+                ], ordered=False)
+                reindexed += len(docs)
+                logger.info(f"[Search] Indexed {len(docs)} {self.config.document}")
+        finally:
+            await RedisClient().release_locks([lock], token)
+        return reindexed
+
+
+    async def search(self, keywords: List[SearchKeyword], skip = 0, limit = MAX_QUERY_LENGTH):
+        """
+        > Find the records matching any keyword, ranked by the number of matched keywords. Keywords on
+        `search_fields` match word prefixes through the `_search` index, the other fields fall back to a
+        case-insensitive regex scan
+        
+        :param keywords: The field and key to search
+        :type keywords: List[SearchKeyword]
+        :param skip: The number of records to skip
+        :param limit: The maximum number of records to return
+        :return: A list of BaseList objects
+        """
+        conditions = []
         for x in keywords:
-            x.key = x.key.strip().replace('\\', '')
-            for c in ['(', ')', '[', ']']: x.key = x.key.replace(c, f"\{c}")
-        if all((x.key == '' for x in keywords)): return []
-        query = {
-            '$or': [
-                { x.field: { '$regex': x.key, '$options': 'i' } }
-                for x in keywords
-            ]
-        }
-        return await self.find_many(
-            query, limit=MAX_QUERY_LENGTH, skip=skip
-        )
+            if (key := x.key.strip()) == '': continue
+            if x.field in self.config.search_fields and len(tokens := self.search_tokens(key, False)) > 0:
+                path = f'_search.{self.search_key(x.field)}'
+                conditions.append((
+                    { path: { '$all': tokens } },
+                    { '$setIsSubset': [tokens, { '$ifNull': [f'${path}', []] }] }
+                ))
+            else:
+                # Scored like the `$match`: an array matches when one of its elements does, and the
+                # values that do not convert to a string never match
+                values = { '$cond': [{ '$isArray': f'${x.field}' }, f'${x.field}', [f'${x.field}']] }
+                conditions.append((
+                    { x.field: { '$regex': re.escape(key), '$options': 'i' } },
+                    { '$in': [True, { '$map': { 'input': values, 'in': { '$regexMatch': {
+                        'input': { '$convert': { 'input': '$$this', 'to': 'string', 'onError': '', 'onNull': '' } },
+                        'regex': re.escape(key), 'options': 'i'
+                    } } } }] }
+                ))
+        if len(conditions) == 0: return []
+        return [self.transform_list(x) for x in await self.find_aggregate([
+            { '$match': { '$or': [x[0] for x in conditions] } },
+            { '$addFields': { '_score': { '$add': [{ '$cond': [x[1], 1, 0] } for x in conditions] } } },
+            { '$sort': { '_score': -1, '_id': -1 } },
+            { '$skip': skip }, { '$limit': limit }
+        ])]
+
+
+    async def post_write(self, ids: List[ObjectId] | None = None, tags: List[str] | None = None):
+        """
+        > Called after every write through the service, drops the cached counts of the document and
+        invalidates its memoized results
+        
+        :param ids: The ids of the written records
+        :type ids: List[ObjectId] | None
+        :param tags: The memoized results to invalidate, all of the document by default
+        :type tags: List[str] | None
+        """
+        await RedisClient().delete_cache(f'_count:{self.config.document}')
+        await RedisClient().incr_keys([
+            f'_memo:{self.config.document}:tag:{x}' for x in (tags if tags is not None else [ALL_TAG])
+        ], MEMOIZE_TAG_TTL)
 
 
     # CREATE
@@ -263,16 +740,16 @@ class BaseService():
         if len(messages) > 0:
             raise HTTPException(status_code=400, detail='\n '.join(messages))
         data = self.transform_master(data.dict())
-        inserted_result = await self.db_client().insert_one(
-            {k: v for k, v in data.dict().items() if v is not None}
-        )
-        new_item = await self.find({
-            "_id": inserted_result.inserted_id
-        })
+        doc = {k: v for k, v in data.dict().items() if v is not None}
+        inserted_result = await self.db_client().insert_one(self.search_document(doc))
+        # Write-through: the record is the inserted document, no need to read it back
+        new_item = self.transform_list({**doc, '_id': inserted_result.inserted_id})
 
-        await self.cache_update(new_item)
+        async with RedisClient().pipeline(transaction=True):
+            await self.cache_update(new_item)
+            await self.post_write([new_item.id])
 
-        return json.loads((await self.build_record(new_item, user)).json())
+        return encode_json((await self.build_record(new_item, user)).dict())
 
 
     async def create_many(self, data: List[BaseCreate], user: UserList = None, **kwargs):
@@ -290,26 +767,30 @@ class BaseService():
         if len(messages) > 0:
             raise HTTPException(status_code=400, detail='\n '.join(messages))
         data = [self.transform_master(x.dict()) for x in data]
-        inserted_result = await self.db_client().insert_many(
-            [{
-                k: v for k, v in x.dict().items() if v is not None
-            } for x in data]
-        )
-        items: List[BaseList] = await self.find_many({
-            '_id': { '$in': inserted_result.inserted_ids } 
-        })
+        docs = [{
+            k: v for k, v in x.dict().items() if v is not None
+        } for x in data]
+        inserted_result = await self.db_client().insert_many([self.search_document(x) for x in docs])
+        items: List[BaseList] = [
+            self.transform_list({**doc, '_id': id})
+            for doc, id in zip(docs, inserted_result.inserted_ids)
+        ]
 
-        await self.cache_update(items)
+        async with RedisClient().pipeline(transaction=True):
+            await self.cache_update(items)
+            await self.post_write([x.id for x in items])
 
-        return [json.loads((await self.build_record(x, user)).json()) for x in items]
+        return [encode_json((await self.build_record(x, user)).dict()) for x in items]
 
 
     # UPDATE
-    async def post_update(self, id: ObjectId) -> None | dict:
-        if (updated_item := await self.find({"_id": id})) is None:
+    async def post_update(self, id: ObjectId, updated_item: BaseList | None = None) -> None | dict:
+        if updated_item is None and (updated_item := await self.find({"_id": id})) is None:
             raise HTTPException(status_code=404, detail=f"Data not found.")
-        await self.cache_update(updated_item)
-        return json.loads((await self.build_record(updated_item)).json())
+        async with RedisClient().pipeline(transaction=True):
+            await self.cache_update(updated_item)
+            await self.post_write([id])
+        return encode_json((await self.build_record(updated_item)).dict())
     
 
     async def update(self, data: BaseUpdate, user: UserList = None, **kwargs):
@@ -325,15 +806,17 @@ class BaseService():
         messages, data = await self.validate_update(data, user, **kwargs)
         if len(messages) > 0:
             raise HTTPException(status_code=400, detail='\n '.join(messages))
-        await self.db_client().update_one({
+        values = { k:v for k, v in data.dict().items() if v is not None and not k == 'id' }
+        updated_doc = await self.db_client().find_one_and_update({
             '_id': data.id
         }, {
             '$set': { 
-                **{ k:v for k, v in data.dict().items() if v is not None and not k == 'id' },
+                **values,
+                **{ f'_search.{k}': v for k, v in self.search_values(values, True).items() },
                 'modified_at': datetime.utcnow()
             }
-        }, upsert=True)
-        return await self.post_update(data.id)
+        }, upsert=True, return_document=ReturnDocument.AFTER)
+        return await self.post_update(data.id, self.transform_list(updated_doc))
 
 
     async def update_many(self, data: List[BaseUpdate], user: UserList = None, **kwargs):
@@ -351,25 +834,32 @@ class BaseService():
         if len(messages) > 0:
             raise HTTPException(status_code=400, detail='\n '.join(messages))
         # Update accounts
+        updates = {
+            d.id: { 
+                **{ k:v for k, v in d.dict().items() if v is not None and not k == 'id' },
+                'modified_at': datetime.utcnow()
+            } for d in data
+        }
         await self.db_client().bulk_write([
-            UpdateOne({
-                '_id': d.id,
-            }, {
-                '$set': { 
-                    **{ k:v for k, v in d.dict().items() if v is not None and not k == 'id' },
-                    'modified_at': datetime.utcnow()
-                }
-            }, upsert=True) for d in data
+            UpdateOne({'_id': k}, {'$set': {
+                **v, **{ f'_search.{kk}': vv for kk, vv in self.search_values(v, True).items() }
+            }}, upsert=True) for k, v in updates.items()
         ], ordered=False)
 
-        # Find the updated accounts
-        items: List[BaseList] = await self.find_many({
-            '_id': { '$in': [x.id for x in data] }
-        })
+        # Assemble the updated accounts from the cached records, only the uncached ones are read back
+        items = {
+            x.id: self.transform_list({**x.dict(), **updates[x.id]})
+            for x in await self.cache_get_keys([str(x) for x in updates])
+        }
+        if len(missing := [x for x in updates if x not in items]) > 0:
+            items.update({x.id: x for x in await self.find_many({'_id': {'$in': missing}})})
+        items: List[BaseList] = [items[x] for x in updates if x in items]
 
-        await self.cache_update(items)
+        async with RedisClient().pipeline(transaction=True):
+            await self.cache_update(items)
+            await self.post_write([x.id for x in items])
 
-        return  [json.loads(x.json()) for x in await self.build_record(items)]
+        return  [encode_json(x.dict()) for x in await self.build_record(items)]
 
 
     async def update_status(self, item_id: str | List[str], status: str):
@@ -396,12 +886,14 @@ class BaseService():
             if (
                 updated_items := await self.find_many({"_id": {"$in": [ObjectId(x) for x in item_id]}})
             ) is not None:
-                await self.cache_update(updated_items)
+                async with RedisClient().pipeline(transaction=True):
+                    await self.cache_update(updated_items)
+                    await self.post_write([x.id for x in updated_items])
                 piped_items = await self.build_record(updated_items)
                 if is_single:
-                    return json.loads(piped_items[0].json())
+                    return encode_json(piped_items[0].dict())
                 else:
-                    return [json.loads(x.json()) for x in piped_items]
+                    return [encode_json(x.dict()) for x in piped_items]
         
         raise HTTPException(
             status_code=404, detail=f"Data not found.")
@@ -420,26 +912,145 @@ class BaseService():
         result = await self.db_client().delete_many({
             '_id': {'$in': [ObjectId(i) for i in ids]}
         })
-        await self.cache_delete(ids)
+        async with RedisClient().pipeline(transaction=True):
+            await self.cache_delete(ids)
+            # Lookups of the deleted ids stop at the tombstones, and reads started before the
+            # delete do not cache the records again, see `cache_fill`
+            await self.cache_tombstone([ObjectId(i) for i in ids])
+            await self.post_write([ObjectId(i) for i in ids])
         return { 'deleted_count': result.deleted_count, "deleted_id": ids}
 
 
     # Caching
+    def schema_hash(self) -> str:
+        """
+        > A short hash of the `py_list_class` schema and `CACHE_VERSION`, cached records live under
+        it so a deploy changing the records shape never reads the entries of the previous one
+        
+        :return: An 8 characters hex digest
+        """
+        schema = self.config.py_list_class.schema() if self.config.py_list_class is not None else None
+        return hashlib.md5(
+            json.dumps([CACHE_VERSION, schema], sort_keys=True, default=str).encode()
+        ).hexdigest()[:8]
+
+
+    def cache_key(self, id: ObjectId | str) -> str:
+        return f'{self.config.document}:{self.cache_namespace}:{id}'
+
+
+    def cache_info(self) -> dict:
+        """
+        > Return the hit/miss counters of `cache_lookup` since the service was created
+        
+        :return: A dictionary with the hits, misses and hit ratio
+        """
+        total = self.cache_stats['hits'] + self.cache_stats['misses']
+        return {
+            'document': self.config.document,
+            **self.cache_stats,
+            'hit_ratio': self.cache_stats['hits'] / total if total > 0 else None
+        }
+
+
     async def cache_clear(self):
+        local_cache.clear(f'{self.config.document}:')
         await RedisClient().delete_pattern(f'{self.config.document}:*')
 
 
-    async def cache_get_keys(self, keys) -> List[BaseList]:
-        cached_data = await RedisClient().get_keys([f'{self.config.document}:{x}' for x in keys])
-        return [self.transform_list(x) for x in cached_data]
+    async def cache_read(self, keys, fields: List[str] | None = None) -> Tuple[List[BaseList], Set[ObjectId]]:
+        """
+        > Read cached records, with the `hash` layout only the given fields can be read, the other
+        attributes of the returned records are left to their defaults
+        
+        :param keys: The ids of the records
+        :param fields: The attributes to read, all of them by default
+        :return: The records, and the ids cached as missing from the database
+        """
+        if self.config.cache_layout == 'hash':
+            cached_data = await RedisClient().get_hashes(
+                [self.cache_key(x) for x in keys], [*fields, TOMBSTONE_FIELD] if fields is not None else None
+            )
+        else:
+            cached_data = await RedisClient().get_keys([self.cache_key(x) for x in keys])
+        return (
+            [self.transform_list(x) for x in cached_data if not x.get(TOMBSTONE_FIELD)],
+            {ObjectId(x['id']) for x in cached_data if x.get(TOMBSTONE_FIELD)}
+        )
+
+
+    async def cache_get_keys(self, keys, fields: List[str] | None = None) -> List[BaseList]:
+        return (await self.cache_read(keys, fields))[0]
     
 
+    async def cache_iter_all(self) -> AsyncIterator[List[BaseList]]:
+        """
+        > Iterate the cached records of the document in batches, with SCAN and one MGET per batch.
+        The tombstones of the ids missing from the database are skipped
+        
+        :return: An async iterator of lists of BaseList objects
+        """
+        async for cached_data in RedisClient().iter_pattern(
+            self.cache_key('*'), hashes=self.config.cache_layout == 'hash'
+        ):
+            if len(items := [self.transform_list(x) for x in cached_data if not x.get(TOMBSTONE_FIELD)]) > 0:
+                yield items
+
+
     async def cache_get_all(self) -> List[BaseList]:
-        if (
-            cached_data := await RedisClient().get_pattern(f'{self.config.document}:*')
-        ) is None:
-            return []
-        return [self.transform_list(x) for x in cached_data]
+        return [x async for items in self.cache_iter_all() for x in items]
+
+
+    async def cache_drop_stale(self) -> int:
+        """
+        > Delete the cached records of the document written under another namespace, by a previous
+        schema or version of the app
+        
+        :return: The number of deleted keys
+        """
+        deleted = 0
+        current = self.cache_key('')
+        async for keys in RedisClient().scan_keys(f'{self.config.document}:*'):
+            if len(stale := [k for k in keys if not k.startswith(current)]) > 0:
+                deleted += await RedisClient().delete_cache(*stale)
+        return deleted
+
+
+    async def cache_warm_up(self, query: dict, batch_size=ITER_BATCH_SIZE) -> int:
+        """
+        > Preload the records matching the query into the cache, one batch at a time
+        
+        :param query: The query selecting the records to preload
+        :param batch_size: The number of records read and cached at once
+        :return: The number of cached records
+        """
+        cached = 0
+        async for items in self.iter_many(query, batch_size=batch_size):
+            await self.cache_update(items)
+            cached += len(items)
+        return cached
+
+
+    async def cache_write(self, data: Dict[str, dict], ex: int | None, jitter: float = 0, nx: bool = False):
+        if self.config.cache_layout == 'hash':
+            await RedisClient().set_hashes(data, ex=ex, jitter=jitter, nx=nx)
+        else:
+            await RedisClient().set_keys(data, ex=ex, jitter=jitter, nx=nx)
+
+
+    async def cache_tombstone(self, ids: List[ObjectId], nx: bool = False):
+        """
+        > Cache the ids missing from the database for `NEGATIVE_CACHE_TTL` seconds, so lookups of
+        unknown ids do not reach the database. The tombstones are replaced by `cache_update`
+        
+        :param ids: The ids confirmed missing
+        :param nx: Only for the ids not cached yet
+        """
+        if len(ids) == 0: return
+        encode = (lambda x: x) if RedisClient().codec.native_types else str
+        await self.cache_write({
+            self.cache_key(x): {'id': encode(x), TOMBSTONE_FIELD: True} for x in ids
+        }, NEGATIVE_CACHE_TTL, nx=nx)
 
 
     async def cache_update(self, items: List[BaseList] | BaseList):
@@ -450,45 +1061,161 @@ class BaseService():
         :type data: List[BaseList], BaseList]
         """
         if not isinstance(items, list): items = [items]
+        # Codecs with native datetime/ObjectId support store the values as they are
+        encode = (lambda x: x) if RedisClient().codec.native_types else encode_json
         data = { 
-            f'{self.config.document}:{x.id}': json.loads(x.json())
+            self.cache_key(x.id): encode(x.dict())
             for x in items 
         }
-        if len(data) > 0: await RedisClient().set_keys(data)
+        if len(data) == 0: return
+        async with RedisClient().pipeline(transaction=True):
+            await self.cache_write(data, self.config.cache_ttl, self.config.cache_ttl_jitter)
+            if self.config.local_cache:
+                local_cache.set_many({self.cache_key(x.id): x.copy() for x in items})
+                await RedisClient().publish_invalidation(list(data.keys()))
 
 
-    async def cache_lookup(self, item_ids: ObjectId | List[ObjectId]) -> BaseList | List[BaseList]:
+    async def cache_lookup(self, item_ids: ObjectId | List[ObjectId], fields: List[str] | None = None) -> BaseList | List[BaseList]:
         """
         It takes a list of item ids, checks if they're in the cache, and if they're not, it fetches them
-        from the database and adds them to the cache
+        from the database and adds them to the cache. The records are returned in the order of the
+        requested ids, ids that do not exist in the database are left out.
         
         :param item_ids: The list of item ids to look up
         :type item_ids: ObjectId | List[ObjectId]
+        :param fields: The attributes the caller needs, with the `hash` layout only those are read
+        from Redis. Records from the local cache or the database are complete
         :return: A list of BaseList objects
         """
         is_single = not isinstance(item_ids, list)
         if is_single: item_ids = [item_ids]
         item_ids = list(dict.fromkeys([ObjectId(x) for x in item_ids if ObjectId.is_valid(x)]).keys())
-        items = await self.cache_get_keys([str(x) for x in item_ids])
-        data_to_refetch = [
-            x for x in item_ids if next(
-                (xx for xx in items if xx.id == x), None
-            ) is None
-        ]
+        items, missing = {}, set()
+        if self.config.local_cache:
+            # Copies, so callers mutating a record do not alter the shared cached object
+            items = {
+                x.id: x.copy() for x in local_cache.get_many([self.cache_key(x) for x in item_ids]).values()
+            }
+        if len(items) < len(item_ids):
+            cached_items, missing = await self.cache_read([str(x) for x in item_ids if x not in items], fields)
+            # Partial records are never kept in the local cache
+            if self.config.local_cache and len(cached_items) > 0 and fields is None:
+                local_cache.set_many({self.cache_key(x.id): x.copy() for x in cached_items})
+            items.update({x.id: x for x in cached_items})
+        data_to_refetch = [x for x in item_ids if x not in items and x not in missing]
+        self.cache_stats['hits'] += len(item_ids) - len(data_to_refetch)
+        self.cache_stats['misses'] += len(data_to_refetch)
+        self.cache_stats['tombstones'] += len(missing)
         if len(data_to_refetch) > 0:
-            refetch_items = await self.find_many({'_id': {'$in': data_to_refetch}})
-            await self.cache_update(refetch_items)
-            items = await self.cache_get_keys([str(x) for x in item_ids])
+            items.update(await self.cache_refetch(data_to_refetch))
+        items = [items[x] for x in item_ids if x in items]
         if is_single:
             return items[0] if len(items) > 0 else None
         else:
             return items
       
 
+    async def cache_refetch(self, item_ids: List[ObjectId]) -> Dict[ObjectId, BaseList]:
+        """
+        > Read the records missing from the cache, with one read per id at a time in the process.
+        The ids already being read by another lookup are awaited instead of read again, and read
+        here if that lookup fails or is cancelled
+        
+        :param item_ids: The ids missing from the cache
+        :return: The records found, by id
+        """
+        loop = asyncio.get_running_loop()
+        waiting = {x: self.cache_inflight[x] for x in item_ids if x in self.cache_inflight}
+        owned = {x: loop.create_future() for x in item_ids if x not in waiting}
+        self.cache_inflight.update(owned)
+        try:
+            items = await self.cache_fetch(list(owned.keys())) if len(owned) > 0 else {}
+            for x, future in owned.items(): future.set_result(items.get(x))
+        except BaseException:
+            # A failed or cancelled read is not passed on, the waiters read the ids themselves
+            for future in owned.values(): future.cancel()
+            raise
+        finally:
+            for x in owned: self.cache_inflight.pop(x, None)
+        if len(waiting) > 0: await asyncio.wait(waiting.values())
+        fallback = []
+        for x, future in waiting.items():
+            if future.cancelled():
+                fallback.append(x)
+            elif (item := future.result()) is not None:
+                # Copies, the record is shared with the lookup that read it
+                items[x] = item.copy()
+        if len(fallback) > 0: items.update(await self.cache_fetch(fallback))
+        return items
+
+
+    async def cache_fetch(self, item_ids: List[ObjectId]) -> Dict[ObjectId, BaseList]:
+        """
+        > Read records from the database into the cache. With `cache_lock`, a Redis lock per id
+        lets a single worker read it, the others wait for the record to show up in the cache, or
+        read it themselves once the lock is released or expired without it
+        
+        :param item_ids: The ids to read
+        :return: The records found, by id
+        """
+        if not self.config.cache_lock:
+            return await self.cache_read_through(item_ids)
+        locks = {x: f'_lock:{self.cache_key(x)}' for x in item_ids}
+        token = uuid.uuid4().hex
+        acquired = set(await RedisClient().acquire_locks(list(locks.values()), token, CACHE_LOCK_TIMEOUT_MS))
+        try:
+            items = await self.cache_read_through([x for x in item_ids if locks[x] in acquired])
+        finally:
+            await RedisClient().release_locks(list(acquired), token)
+        pending = [x for x in item_ids if locks[x] not in acquired]
+        missing = set()
+        deadline = time.monotonic() + CACHE_LOCK_TIMEOUT_MS / 1000
+        while len(pending) > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(CACHE_LOCK_POLL_MS / 1000)
+            cached_items, tombstones = await self.cache_read([str(x) for x in pending])
+            items.update({x.id: x for x in cached_items})
+            missing.update(tombstones)
+            pending = [x for x in pending if x not in items and x not in missing]
+            held = set(await RedisClient().held_locks([locks[x] for x in pending]))
+            pending = [x for x in pending if locks[x] in held]
+        items.update(await self.cache_read_through([
+            x for x in item_ids if x not in items and x not in missing and locks[x] not in acquired
+        ]))
+        return items
+
+
+    async def cache_read_through(self, item_ids: List[ObjectId]) -> Dict[ObjectId, BaseList]:
+        if len(item_ids) == 0: return {}
+        items = {x.id: x for x in await self.find_many({'_id': {'$in': item_ids}})}
+        await self.cache_fill(list(items.values()), [x for x in item_ids if x not in items])
+        return items
+
+
+    async def cache_fill(self, items: List[BaseList], missing: List[ObjectId]):
+        """
+        > Cache the records read from the database and the tombstones of the ids found missing, only
+        for the keys not cached meanwhile. A read finishing after a write never replaces what the
+        write cached, e.g. a record read before `delete_many` does not come back over its tombstone
+        
+        :param items: The records read
+        :param missing: The ids not found
+        """
+        encode = (lambda x: x) if RedisClient().codec.native_types else encode_json
+        async with RedisClient().pipeline(transaction=True):
+            if len(items) > 0:
+                await self.cache_write({
+                    self.cache_key(x.id): encode(x.dict()) for x in items
+                }, self.config.cache_ttl, self.config.cache_ttl_jitter, nx=True)
+            await self.cache_tombstone(missing, nx=True)
+
+
     async def cache_delete(self, ids: List[ObjectId]):
         if len(ids) == 0: return
-        await RedisClient().delete_cache(*[
-            f'{self.config.document}:{x}' for x in ids
-        ])
+        keys = [self.cache_key(x) for x in ids]
+        async with RedisClient().pipeline(transaction=True):
+            await RedisClient().delete_cache(*keys)
+            if self.config.local_cache:
+                local_cache.delete_many(keys)
+                await RedisClient().publish_invalidation(keys)
 
     
\ No newline at end of file
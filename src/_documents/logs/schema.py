@@ -17,6 +17,7 @@ class Action(BaseModel):
     user_email: str | None 
     method: str | None 
     url: str | None 
+    path: str | None 
     path_params: dict | None 
     query_params: dict | None 
     body: dict | List | None 
@@ -1,11 +1,20 @@
+import asyncio
+import hashlib
 import json
-from datetime import datetime, timedelta
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
 from typing import List
+from urllib.parse import urlsplit
 from bson import ObjectId
-from fastapi import Request, Depends
+from fastapi import HTTPException, Request, Depends
+from pymongo import IndexModel, ReadPreference, ReturnDocument, UpdateOne
 from _documents._base.service import BaseService
 from _documents._base.schema import ServiceBaseConfig
 from _services.mongo.client import MongoDbClient
+from config.settings import (DATE_STR_FORMAT, LOG_BATCH_SIZE, LOG_BODY_MAX_SIZE, LOG_FLUSH_INTERVAL_MS,
+                             LOG_MIGRATION_LEASE, LOG_QUEUE_SIZE, LOG_RETENTION_DAYS,
+                             LOG_ROLLUP_RETENTION_DAYS, MAX_FETCH_LIMIT)
 
 from .schema import Action, Log
 from _documents.users.schema import UserList
@@ -13,55 +22,266 @@ from _documents.users.service import user_service
 from utils.logger import logger
 
 
+ACTION_INDEXES = [
+    # Mongo removes the actions past the retention period in the background
+    IndexModel('timestamp', name='timestamp', expireAfterSeconds=LOG_RETENTION_DAYS * 24 * 3600),
+    # Equality filter first, then the (timestamp, _id) order of the pages
+    IndexModel([('user_id', 1), ('timestamp', -1), ('_id', -1)], name='user_id_timestamp'),
+    IndexModel([('call_type', 1), ('timestamp', -1), ('_id', -1)], name='call_type_timestamp'),
+    IndexModel([('path', 1), ('method', 1), ('timestamp', -1), ('_id', -1)], name='path_method_timestamp'),
+]
+
+ROLLUP_INDEXES = [
+    IndexModel([('hour', 1), ('call_type', 1), ('user_id', 1)], name='hour_call_type_user_id', unique=True),
+    IndexModel('hour', name='hour', expireAfterSeconds=LOG_ROLLUP_RETENTION_DAYS * 24 * 3600),
+]
+
+ROLLUP_GROUPS = ['call_type', 'user_id']
+
+
 class LoggingService(BaseService):
 
+    def __init__(self, config: ServiceBaseConfig):
+        super().__init__(config)
+        self.queue: asyncio.Queue | None = None
+        self.writer: asyncio.Task | None = None
+        self.writer_stats = {'queued': 0, 'written': 0, 'dropped': 0, 'failed': 0}
+
+
     def db_client(self):
         return MongoDbClient().get_docs('logs')
 
-    async def create(self, action: Action):
-        date = datetime.utcnow().strftime("%Y-%m-%d")
-        if (
-            log_info := await self.db_client().find_one({
-                'date': date
-            })
-        ) is not None:
-            return await self.db_client().update_one(
-                {'_id': log_info['_id']}, {"$push": {"action": action.dict()}}
-            )
 
-        return await self.db_client().insert_one(
-            Log(**{"action": [action.dict()], 'date': date}).dict()
-        )
+    def actions_client(self):
+        """
+        > The actions are appended one document each to their own collection, the per-day `logs`
+        documents are only read for the days not migrated yet, see `migrate_logs`
+        """
+        return MongoDbClient().get_docs('log_actions')
+
 
-    async def request_create(self, call_type: str, request: Request, user: UserList, **kwargs):
+    def rollups_client(self):
+        """
+        > The number of actions per hour, call type and user, counted as the actions are written
+        """
+        return MongoDbClient().get_docs('log_rollups')
+
+
+    async def sync_indexes(self):
+        await super().sync_indexes()
+        await self.sync_collection_indexes(self.actions_client(), ACTION_INDEXES)
+        await self.sync_collection_indexes(self.rollups_client(), ROLLUP_INDEXES)
+
+
+    async def create(self, action: Action):
+        """
+        > Queue the action for the background writer, or insert it right away when the writer is not
+        running. While the queue is full the new actions are dropped, so logging never holds up the
+        request being logged
+        
+        :param action: Action
+        :type action: Action
+        """
+        if self.writer is None:
+            return await self.write_actions([action.dict()])
+        try:
+            self.queue.put_nowait(action.dict())
+            self.writer_stats['queued'] += 1
+        except asyncio.QueueFull:
+            if self.writer_stats['dropped'] % LOG_BATCH_SIZE == 0:
+                logger.warning(f"[Logs] Queue is full, {self.writer_stats['dropped'] + 1} actions dropped so far")
+            self.writer_stats['dropped'] += 1
+
+    async def request_create(self, call_type: str, request: Request, user: UserList | None, **kwargs):
+        """
+        > Log the request. The `body` may be given already parsed, or as the raw bytes read by the
+        caller, otherwise it is read from the request. Without a `user`, the `user_id` and
+        `user_email` given are logged
+        """
         if (body := kwargs.get('body')) is None:
             body = await request.body()
-            body = json.loads(body) if len(body) < 100 and len(body) > 0 else None
+        if isinstance(body, bytes):
+            try:
+                body = json.loads(body) if 0 < len(body) < LOG_BODY_MAX_SIZE else None
+            except ValueError:
+                body = None
         action = Action(**{
             "call_type": call_type,
             "ip_address": request.headers.get('x-real-ip') or request.client.host,
             "user_agent": request.headers.get("user-agent"),
-            "user_id": str(user.id) if user is not None else None,
-            "user_email": user.email if user is not None else None,
+            "user_id": str(user.id) if user is not None else kwargs.get('user_id'),
+            "user_email": user.email if user is not None else kwargs.get('user_email'),
             "method": request.method,
             "url": str(request.url),
+            "path": request.url.path,
             "path_params": request.path_params,
             "query_params": dict(request.query_params),
             "body": body
         })
         return await self.create(action)
     
+    async def insert_actions(self, actions: List[dict]):
+        """
+        > Insert the actions and add them to the hourly rollups
+        """
+        await self.actions_client().insert_many(actions, ordered=False)
+        await self.rollup_actions(actions)
+
+
+    async def upsert_actions(self, actions: List[dict]) -> int:
+        """
+        > Insert the actions whose `_id` is not written yet, only those are added to the rollups so
+        writing the same actions again changes nothing
+        
+        :return: The number of inserted actions
+        """
+        if len(actions) == 0: return 0
+        result = await self.actions_client().bulk_write([
+            UpdateOne({'_id': x['_id']}, {'$setOnInsert': {k: v for k, v in x.items() if k != '_id'}}, upsert=True)
+            for x in actions
+        ], ordered=False)
+        await self.rollup_actions([actions[i] for i in result.upserted_ids])
+        return len(result.upserted_ids)
+
+
+    async def rollup_actions(self, actions: List[dict]):
+        if len(actions) == 0: return
+        counts = Counter(
+            (x['timestamp'].replace(minute=0, second=0, microsecond=0), x.get('call_type'), x.get('user_id'))
+            for x in actions
+        )
+        await self.rollups_client().bulk_write([
+            UpdateOne(
+                {'hour': hour, 'call_type': call_type, 'user_id': user_id},
+                {'$inc': {'count': n}},
+                upsert=True
+            ) for (hour, call_type, user_id), n in counts.items()
+        ], ordered=False)
+
+
+    async def write_actions(self, actions: List[dict]):
+        try:
+            await self.insert_actions(actions)
+            self.writer_stats['written'] += len(actions)
+        except Exception as e:
+            logger.error(f"[Logs] Unable to write {len(actions)} actions: {e}")
+            self.writer_stats['failed'] += len(actions)
+
+
+    async def flush_actions(self):
+        """
+        > Write the queued actions in batches of up to `LOG_BATCH_SIZE`, a batch is written at the
+        latest `LOG_FLUSH_INTERVAL_MS` after its first action was taken from the queue. Returns once
+        the `None` sentinel queued by `stop` is reached
+        """
+        loop = asyncio.get_running_loop()
+        stopped = False
+        while not stopped:
+            if (action := await self.queue.get()) is None:
+                break
+            batch = [action]
+            deadline = loop.time() + LOG_FLUSH_INTERVAL_MS / 1000
+            while len(batch) < LOG_BATCH_SIZE and (timeout := deadline - loop.time()) > 0:
+                try:
+                    action = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if action is None:
+                    stopped = True
+                    break
+                batch.append(action)
+            await self.write_actions(batch)
+
+
+    def start(self):
+        if self.writer is not None: return
+        self.queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.writer = asyncio.create_task(self.flush_actions())
+
+
+    async def stop(self):
+        """
+        > Write the actions still queued and stop the writer, the actions logged afterwards are
+        inserted one by one
+        """
+        if self.writer is None: return
+        writer, self.writer = self.writer, None
+        await self.queue.put(None)
+        await writer
+        self.queue = None
+
+
+    def writer_info(self):
+        return {
+            **self.writer_stats,
+            'running': self.writer is not None,
+            'queue_size': self.queue.qsize() if self.queue is not None else 0,
+            'max_queue_size': LOG_QUEUE_SIZE,
+        }
+
     # READ
     async def find(self, query, select=None, sort=None) -> Log:
         return await super().find(query, select, sort)
 
 
-    async def find_many(self, query, select=None, sort=None, limit=None, skip=None) -> List[Log]:
-        return await super().find_many(query, select, sort, limit, skip)
+    async def find_many(self, query, select=None, sort=None, limit=None, skip=None, cursor=None) -> List[Log]:
+        return await super().find_many(query, select, sort, limit, skip, cursor)
     
 
-    async def cache_lookup(self, item_ids: ObjectId | List[ObjectId]) -> Log | List[Log]:
-        return await super().cache_lookup(item_ids)
+    async def cache_lookup(self, item_ids: ObjectId | List[ObjectId], fields: List[str] | None = None) -> Log | List[Log]:
+        return await super().cache_lookup(item_ids, fields)
+
+
+    async def find_actions(
+        self, user_id: str | None = None, call_type: str | None = None, method: str | None = None,
+        path: str | None = None, start: datetime | None = None, end: datetime | None = None,
+        limit: int = MAX_FETCH_LIMIT, cursor: str = ''
+    ) -> dict:
+        """
+        > Return a page of the actions matching the filters, the latest first
+        
+        :param start: The earliest timestamp, included
+        :param end: The latest timestamp, excluded
+        :param limit: The page size, at most `MAX_FETCH_LIMIT`
+        :param cursor: The `next_cursor` of the previous page, an empty string for the first page
+        :return: A dictionary with the `items` and the `next_cursor`, None on the last page
+        """
+        query = {k: v for k, v in {
+            'user_id': user_id, 'call_type': call_type, 'method': method, 'path': path
+        }.items() if v is not None}
+        if start is not None or end is not None:
+            query['timestamp'] = {
+                **({'$gte': start} if start is not None else {}), **({'$lt': end} if end is not None else {})
+            }
+        limit = min(limit, MAX_FETCH_LIMIT)
+        docs = await self.actions_client().find(
+            self.cursor_query(query, cursor, 'timestamp')
+        ).sort([('timestamp', -1), ('_id', -1)]).limit(limit).to_list(length=limit)
+        return {
+            'items': [self.transform_raw(x, Action) for x in docs],
+            'next_cursor': self.encode_cursor(docs[-1], 'timestamp') if len(docs) == limit else None
+        }
+
+
+    async def find_rollups(self, start: datetime, end: datetime | None = None, group_by: str = 'call_type') -> List[dict]:
+        """
+        > Return the number of actions per hour and call type or user, read from the rollups only
+        
+        :param start: The earliest hour, included
+        :param end: The latest hour, excluded
+        :param group_by: `call_type` or `user_id`
+        :return: A list of `{hour, <group_by>, count}` sorted by hour
+        """
+        if group_by not in ROLLUP_GROUPS:
+            raise HTTPException(status_code=400, detail=f"Rollups are grouped by one of {ROLLUP_GROUPS}.")
+        rollups = []
+        async for x in self.rollups_client().aggregate([
+            {'$match': {'hour': {'$gte': start, **({'$lt': end} if end is not None else {})}}},
+            {'$group': {'_id': {'hour': '$hour', group_by: f'${group_by}'}, 'count': {'$sum': '$count'}}},
+            {'$sort': {'_id.hour': 1, 'count': -1}}
+        ]):
+            rollups.append({'hour': x['_id']['hour'].isoformat(), group_by: x['_id'].get(group_by), 'count': x['count']})
+        return rollups
 
 
     async def find_by_date(self, date: str):
@@ -70,27 +290,91 @@ class LoggingService(BaseService):
             log := await self.db_client().find_one({'date': date})
         ) is not None:
             actions = [
-                json.loads(Action(**x).json()) for x in log['action']
+                self.transform_raw(x, Action) for x in log['action']
             ]
+        start = datetime.strptime(date, DATE_STR_FORMAT)
+        async for x in self.actions_client().find(
+            {'timestamp': {'$gte': start, '$lt': start + timedelta(days=1)}}, {'_id': 0}
+        ).sort('timestamp', 1):
+            actions.append(self.transform_raw(x, Action))
         return actions
     
 
     # cron
-    async def clean_up(self, days = 90):
-        logger.info(f"[CRON] Remove logs that are created more than {days} days ago.")
-        logs = await self.find_many({
-            "date": {"$lte": (datetime.utcnow() - timedelta(days=days)).strftime("%Y-%m-%d")}
-        })
-        if len(logs) > 0:
-            await self.delete_many([x.id for x in logs])
+    @staticmethod
+    def migrated_action_id(log_id: ObjectId, index: int, timestamp: datetime) -> ObjectId:
+        """
+        > The same id on every run for the `index`-th action of a day document, it starts with the
+        timestamp of the action like the ids generated on insert
+        """
+        return ObjectId(
+            int(timestamp.replace(tzinfo=timezone.utc).timestamp()).to_bytes(4, 'big')
+            + hashlib.md5(f'{log_id}:{index}'.encode()).digest()[:8]
+        )
+
+
+    async def migrate_logs(self, batch_size: int = LOG_BATCH_SIZE) -> int:
+        """
+        > Move the actions of the per-day `logs` documents to `log_actions`, `batch_size` actions at
+        a time so a day document is never loaded whole. A process claims a day document for
+        `LOG_MIGRATION_LEASE` seconds, renewed with each slice, and records the position of the next
+        slice in it. The actions get a stable id and are upserted, so a slice copied again after a
+        crash or an expired claim is neither duplicated nor counted twice in the rollups. The day
+        document is deleted once copied. The actions past `LOG_RETENTION_DAYS` are dropped
+        
+        :param batch_size: The number of actions read and inserted at once
+        :return: The number of migrated actions
+        """
+        # The claim and the position are read back right after they are written
+        logs = self.db_client().with_options(read_preference=ReadPreference.PRIMARY)
+        cutoff = datetime.utcnow() - timedelta(days=LOG_RETENTION_DAYS)
+        token = uuid.uuid4().hex
+        migrated = 0
+        async for ids in self.iter_ids({}):
+            for log_id in ids:
+                now = datetime.utcnow()
+                if (
+                    log := await logs.find_one_and_update(
+                        {'_id': log_id, '$or': [{'migration': {'$exists': False}}, {'migration.until': {'$lt': now}}]},
+                        {'$set': {'migration.owner': token, 'migration.until': now + timedelta(seconds=LOG_MIGRATION_LEASE)}},
+                        projection={'migration': 1}, return_document=ReturnDocument.AFTER
+                    )
+                ) is None:
+                    continue
+                offset = log['migration'].get('offset', 0)
+                while (
+                    log := await logs.find_one(
+                        {'_id': log_id, 'migration.owner': token}, {'action': {'$slice': [offset, batch_size]}}
+                    )
+                ) is not None:
+                    if len(log.get('action') or []) == 0:
+                        await self.delete_many([log_id])
+                        break
+                    actions = []
+                    for i, x in enumerate(log['action']):
+                        if x['timestamp'] <= cutoff: continue
+                        if x.get('path') is None and x.get('url'): x['path'] = urlsplit(x['url']).path
+                        actions.append({**x, '_id': self.migrated_action_id(log_id, offset + i, x['timestamp'])})
+                    migrated += await self.upsert_actions(actions)
+                    offset += len(log['action'])
+                    await logs.update_one({'_id': log_id, 'migration.owner': token}, {'$set': {
+                        'migration.offset': offset,
+                        'migration.until': datetime.utcnow() + timedelta(seconds=LOG_MIGRATION_LEASE)
+                    }})
+        if migrated > 0: logger.info(f"[CRON] Migrated {migrated} actions from the daily logs.")
+        return migrated
 
 
 logging_service = LoggingService(ServiceBaseConfig(**{
-    "document": "product",
+    "document": "logs",
     "py_create_class": Log,
     "py_update_class": Log,
     "py_list_class": Log,
     "py_master_class": Log,
     "mongodb_client": MongoDbClient(),
+    "indexes": [
+        IndexModel('date', name='date'),
+    ],
+    "cache_ttl": 300
 }))
 
@@ -41,6 +41,18 @@ class NotificationList(NotificationCreate):
         pass
 
 
+class InboxEntry(BaseModel):
+    id: PyObjectId = Field(None, alias='_id')
+    user_id: PyObjectId
+    notification_id: PyObjectId
+    status: str = 'UNREAD'
+    timestamp: datetime
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+    class Config(BaseConfig):
+        pass
+
+
 class Notification(NotificationCreate):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     modified_at: datetime = Field(default_factory=datetime.utcnow)
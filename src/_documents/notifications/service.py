@@ -1,131 +1,260 @@
-import json
+import uuid
 from datetime import timedelta
 from typing import List
 
 from bson import ObjectId
 from fastapi import HTTPException
+from pymongo import IndexModel, UpdateOne
+from pymongo.errors import BulkWriteError
 
 from _documents._base.schema import ServiceBaseConfig
-from _documents._base.service import BaseService
+from _documents._base.service import BaseService, memoize
 from _documents.users.schema import UserList
 from config.settings import MAX_QUERY_LENGTH
 from _services.mongo.client import MongoDbClient
+from _services.redis.service import RedisClient
 
 from utils.logger import logger
+from utils.schema import encode_json
 
 from .schema import *
 
 
+INBOX_MIGRATION_LOCK = '_lock:_migration:notification_inbox'
+
+INBOX_MIGRATION_LOCK_MS = 3600 * 1000
+
+INBOX_INDEXES = [
+    IndexModel([('user_id', 1), ('notification_id', 1)], name='user_id_notification_id', unique=True),
+    IndexModel([('user_id', 1), ('status', -1), ('timestamp', -1)], name='user_id_status_timestamp'),
+    IndexModel([('user_id', 1), ('created_at', -1), ('_id', -1)], name='user_id_created_at'),
+    IndexModel('notification_id', name='notification_id'),
+]
+
+
 class NotificationService(BaseService):
+
+    def inbox_client(self):
+        """
+        > One entry per recipient and notification holding the status of the recipient, the
+        notification documents hold the content shared by the recipients
+        """
+        return MongoDbClient().get_docs('notification_inbox')
+
+
+    async def sync_indexes(self):
+        await super().sync_indexes()
+        await self.sync_collection_indexes(self.inbox_client(), INBOX_INDEXES)
+
     
     # READ
     async def find(self, query, select=None, sort=None) -> NotificationList:
         return await super().find(query, select, sort)
 
 
-    async def find_many(self, query, select=None, sort=None, limit=None, skip=None) -> List[NotificationList]:
-        return await super().find_many(query, select, sort, limit, skip)
+    async def find_many(self, query, select=None, sort=None, limit=None, skip=None, cursor=None) -> List[NotificationList]:
+        return await super().find_many(query, select, sort, limit, skip, cursor)
 
 
-    async def cache_get_keys(self, keys) -> List[NotificationList]:
-        return await super().cache_get_keys(keys)
+    async def cache_get_keys(self, keys, fields: List[str] | None = None) -> List[NotificationList]:
+        return await super().cache_get_keys(keys, fields)
 
 
-    async def cache_lookup(self, item_ids: ObjectId | List[ObjectId]) -> NotificationList | List[NotificationList]:
-        return await super().cache_lookup(item_ids)
+    async def cache_lookup(self, item_ids: ObjectId | List[ObjectId], fields: List[str] | None = None) -> NotificationList | List[NotificationList]:
+        return await super().cache_lookup(item_ids, fields)
 
 
-    async def fetch_user(self, user: UserList, skip: int = 0, limit: int = 10) -> dict:
-        notifications = [ NotificationList(**x) for x in await self.find_aggregate([
-            {'$unwind': '$users'},
-            {'$match': {'users.user_id': user.id}},
-            {'$sort': { 'users.status': -1, 'timestamp': -1}},
-            {'$skip': +skip}, {'$limit': +limit}, 
-            {'$addFields': { 'status': '$users.status' } },
-            {'$project': {'users': 0}}
-        ])]
-
-        counts: List[dict] = await self.find_aggregate([
-            {'$unwind': '$users'},
-            {'$match': {'users.user_id': user.id}},
+    @memoize(tags=lambda self, user_id: [f'user:{user_id}'])
+    async def count_status(self, user_id: ObjectId) -> List[dict]:
+        return [x async for x in self.inbox_client().aggregate([
+            {'$match': {'user_id': user_id}},
             {'$group':  {
-                '_id': '$users.status',
+                '_id': '$status',
                 'count': {'$sum': 1}
             }}
-        ])
+        ])]
+
+
+    async def inbox_records(self, entries: List[dict]) -> List[NotificationList]:
+        """
+        > Join the inbox entries with the notifications they point to, read through the cache
+        
+        :param entries: The raw inbox entries
+        :return: One record per entry, with the `user` and `status` of the entry
+        """
+        notifications = {x.id: x for x in await self.cache_lookup(list({x['notification_id'] for x in entries}))}
+        return [
+            notifications[x['notification_id']].copy(update={'users': [], 'user': x['user_id'], 'status': x['status']})
+            for x in entries if x['notification_id'] in notifications
+        ]
+
+
+    async def fetch_user(self, user: UserList, skip: int = 0, limit: int = 10, cursor: str | None = None) -> dict:
+        await self.migrate_user_inbox(user.id)
+        if cursor is not None:
+            # Keyset pagination: newest first, starting after the cursor
+            entries = await self.inbox_client().find(
+                self.cursor_query({'user_id': user.id}, cursor)
+            ).sort([('created_at', -1), ('_id', -1)]).limit(limit).to_list(length=limit)
+            next_cursor = self.encode_cursor(entries[-1]) if len(entries) == limit else None
+        else:
+            entries = await self.inbox_client().find(
+                {'user_id': user.id}
+            ).sort([('status', -1), ('timestamp', -1)]).skip(skip).limit(limit).to_list(length=limit)
+            next_cursor = None
+        notifications = await self.inbox_records(entries)
+
+        counts = await self.count_status(user.id)
         total_count = sum([x.get('count') for x in counts], 0)
         unread_count = next((x.get('count') for x in counts if x.get('_id') == 'UNREAD'), 0)
 
         return {
-            'items': sorted([json.loads(x.json()) for x in notifications], key=lambda x: -x['timestamp']),
+            'items': sorted([encode_json(x.dict()) for x in notifications], key=lambda x: -x['timestamp']),
             'total_count': total_count,
-            'unread_count': unread_count
+            'unread_count': unread_count,
+            'next_cursor': next_cursor
         }
 
 
     # UPDATE
     async def push_many(self, data: List[NotificationCreate]):
-        inserted_result = await self.db_client().insert_many(
-            [{
-                **Notification(**x.dict()).dict()
-            } for x in data]
-        )
+        docs = [Notification(**x.dict()).dict() for x in data]
+        inserted_result = await self.db_client().insert_many([
+            {k: v for k, v in doc.items() if k != 'users'} for doc in docs
+        ])
+        # Fan out on write, one inbox entry per recipient
+        if len(entries := [
+            InboxEntry(**{
+                'user_id': x['user_id'], 'notification_id': id, 'status': x['status'],
+                'timestamp': doc['timestamp'], 'created_at': doc['created_at']
+            }).dict(exclude={'id'})
+            for doc, id in zip(docs, inserted_result.inserted_ids) for x in doc['users']
+        ]) > 0:
+            await self.inbox_client().insert_many(entries, ordered=False)
 
-        notifications = [NotificationList(**x) for x in await self.find_aggregate([
-            {'$unwind': '$users'},
-            {'$match': {'_id': {'$in': inserted_result.inserted_ids}}},
-            {'$addFields': { 'user': '$users.user_id', 'status': '$users.status' } },
-            {'$project': {'users': 0}}
-        ])]
+        # One record per recipient, assembled from the inserted documents
+        notifications = [
+            NotificationList(**{
+                **{k: v for k, v in doc.items() if k != 'users'},
+                '_id': id, 'user': x['user_id'], 'status': x['status']
+            })
+            for doc, id in zip(docs, inserted_result.inserted_ids) for x in doc['users']
+        ]
+        # Only the counts of the recipients change
+        await self.post_write(inserted_result.inserted_ids, tags=list({
+            f"user:{x['user_id']}" for doc in docs for x in doc['users']
+        }))
 
         return sorted(notifications, key=lambda x: x.timestamp, reverse=True)
 
 
     async def mark_as_read(self, user: UserList, mode: str = 'partial', notification_ids: List[str] = []):
         # Update the status
+        notification_ids = [ObjectId(x) for x in notification_ids]
         if mode == 'partial':
-            query = { "_id": {'$in': [ObjectId(x) for x in notification_ids]} } 
+            query = { "user_id": user.id, "notification_id": {'$in': notification_ids} }
         elif mode == 'all':
-            query = { "users.user_id": user.id }
+            query = { "user_id": user.id }
         else:
             raise HTTPException(status_code=400, detail=f"Mode {mode} not allowed.")
-        await self.db_client().update_many(
-            query, { "$set": {'users.$[user].status': 'READ'} },
-            array_filters=[{ "user.user_id": user.id, 'user.status': 'UNREAD' }],
-            upsert=False
+        await self.migrate_user_inbox(user.id)
+        await self.inbox_client().update_many(
+            { **query, 'status': 'UNREAD' }, { "$set": {'status': 'READ'} }
         )
+        await self.post_write(tags=[f'user:{user.id}'])
 
-        notifications = [NotificationList(**x) for x in await self.find_aggregate([
-            {'$unwind': '$users'},
-            {'$match': {'_id':  {'$in': [ObjectId(x) for x in notification_ids]}, 'users.user_id': user.id}},
-            {'$addFields': { 'status': '$users.status' } },
-            {'$project': {'users': 0}}
-        ])]
+        notifications = await self.inbox_records(await self.inbox_client().find({
+            "user_id": user.id, "notification_id": {'$in': notification_ids}
+        }).to_list(length=len(notification_ids)))
 
-        counts: List[dict] = await self.find_aggregate([
-            {'$unwind': '$users'},
-            {'$match': {'users.user_id': user.id}},
-            {'$group':  {
-                '_id': '$users.status',
-                'count': {'$sum': 1}
-            }}
-        ])
+        counts = await self.count_status(user.id)
         unread_count = next((x.get('count') for x in counts if x.get('_id') == 'UNREAD'), 0)
 
         return {
-            'items': sorted([json.loads(x.json()) for x in notifications], key=lambda x: -x['timestamp']), 
+            'items': sorted([encode_json(x.dict()) for x in notifications], key=lambda x: -x['timestamp']), 
             'unread_count':unread_count
         }
 
 
+    # DELETE
+    async def delete_many(self, ids: List[str]):
+        # The entries go first, the counts memoized before `post_write` must not include them
+        await self.inbox_client().delete_many({'notification_id': {'$in': [ObjectId(i) for i in ids]}})
+        return await super().delete_many(ids)
+
+
     # cron
+    async def migrate_notifications(self, query: dict) -> List[ObjectId]:
+        """
+        > Move the `users` arrays of the notifications matching the query to `notification_inbox`, a
+        notification at a time. The entries are upserted, so a notification moved by two processes
+        at once or by an interrupted run gets its entries once
+        
+        :param query: The notifications to move, among those still holding recipients
+        :return: The ids of the migrated notifications
+        """
+        migrated, tags = [], set()
+        async for doc in self.db_client().find(query, {'users': 1, 'timestamp': 1, 'created_at': 1}):
+            if len(doc['users']) > 0:
+                try:
+                    await self.inbox_client().bulk_write([
+                        UpdateOne(
+                            {'user_id': x['user_id'], 'notification_id': doc['_id']},
+                            {'$setOnInsert': {
+                                'status': x['status'], 'timestamp': doc['timestamp'],
+                                'created_at': doc.get('created_at', doc['timestamp'])
+                            }},
+                            upsert=True
+                        ) for x in doc['users']
+                    ], ordered=False)
+                except BulkWriteError as e:
+                    # The entries upserted by another process at the same time
+                    if any(x.get('code') != 11000 for x in e.details.get('writeErrors', [])): raise
+            await self.db_client().update_one({'_id': doc['_id']}, {'$unset': {'users': ''}})
+            migrated.append(doc['_id'])
+            tags |= {f"user:{x['user_id']}" for x in doc['users']}
+        if len(migrated) > 0:
+            async with RedisClient().pipeline(transaction=True):
+                await self.cache_delete(migrated)
+                await self.post_write(migrated, tags=list(tags))
+        return migrated
+
+
+    async def migrate_user_inbox(self, user_id: ObjectId) -> List[ObjectId]:
+        """
+        > Move the notifications of the user still holding their recipients before the inbox of the
+        user is read. Those are the notifications pushed before the inbox and not migrated yet, or
+        pushed by the instances not upgraded yet during a deploy
+        """
+        return await self.migrate_notifications({'users.user_id': user_id})
+
+
+    async def migrate_inbox(self) -> int:
+        """
+        > Move the recipients of all the notifications pushed before the inbox, see
+        `migrate_notifications`. A Redis lock keeps the other processes out, the notifications
+        already moved are skipped
+        
+        :return: The number of migrated notifications
+        """
+        token = uuid.uuid4().hex
+        if len(await RedisClient().acquire_locks([INBOX_MIGRATION_LOCK], token, INBOX_MIGRATION_LOCK_MS)) == 0:
+            return 0
+        try:
+            migrated = await self.migrate_notifications({'users.user_id': {'$exists': True}})
+            if len(migrated) > 0:
+                logger.info(f"[CRON] Moved the recipients of {len(migrated)} notifications to their inbox.")
+            return len(migrated)
+        finally:
+            await RedisClient().release_locks([INBOX_MIGRATION_LOCK], token)
+
+
     async def clean_up(self, days = 90):
         logger.info(f"[CRON] Remove notifications that are created more than {days} days ago.")
-        docs = await self.find_many({
+        async for ids in self.iter_ids({
             "created_at": {"$lte": datetime.utcnow() - timedelta(days=days)}
-        })
-        if len(docs) > 0:
-            await self.delete_many([x.id for x in docs])
+        }):
+            await self.delete_many(ids)
 
 
 notification_service = NotificationService(ServiceBaseConfig(**{
@@ -135,4 +264,10 @@ notification_service = NotificationService(ServiceBaseConfig(**{
     "py_list_class": NotificationList,
     "py_master_class": Notification,
     "mongodb_client": MongoDbClient(),
+    "indexes": [
+        IndexModel([('created_at', -1), ('_id', -1)], name='created_at'),
+        # Only the notifications still holding their recipients, see `migrate_notifications`
+        IndexModel('users.user_id', name='users_user_id', sparse=True),
+    ],
+    "cache_ttl": 600
 }))
\ No newline at end of file
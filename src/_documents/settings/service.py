@@ -1,10 +1,12 @@
 from typing import List
 
 from bson import ObjectId
+from pymongo import IndexModel
 
 from _documents._base.schema import ServiceBaseConfig
-from _documents._base.service import BaseService
+from _documents._base.service import BaseService, memoize
 from _documents.settings.schema import *
+from config.settings import MAX_QUERY_LENGTH
 from _services.mongo.client import MongoDbClient
 from _documents._base.schema import List, SearchKeyword
 
@@ -17,11 +19,15 @@ class SettingService(BaseService):
             raise ValueError('Invalid category')
         return 
 
-    async def validate_currency(self, values: List[str]):
+    @memoize()
+    async def get_currencies(self) -> List[str]:
         ex_rates = await self.search(
             keywords=[SearchKeyword(field='group', key='exchange_rate')]
         )
-        valid_values = {xx for x in ex_rates for xx in [x.key[:3], x.key[3:]]}
+        return sorted({xx for x in ex_rates for xx in [x.key[:3], x.key[3:]]})
+
+    async def validate_currency(self, values: List[str]):
+        valid_values = set(await self.get_currencies())
         if any((x not in valid_values for x in values if x is not None)):
             raise ValueError('Invalid currency')
         return 
@@ -51,16 +57,16 @@ class SettingService(BaseService):
         return await super().find(query, select, sort)
 
 
-    async def find_many(self, query, select=None, sort=None, limit=None, skip=None) -> List[SettingList]:
-        return await super().find_many(query, select, sort, limit, skip)
+    async def find_many(self, query, select=None, sort=None, limit=None, skip=None, cursor=None) -> List[SettingList]:
+        return await super().find_many(query, select, sort, limit, skip, cursor)
 
 
-    async def cache_lookup(self, item_ids: ObjectId | List[ObjectId]) -> SettingList | List[SettingList]:
-        return await super().cache_lookup(item_ids)
+    async def cache_lookup(self, item_ids: ObjectId | List[ObjectId], fields: List[str] | None = None) -> SettingList | List[SettingList]:
+        return await super().cache_lookup(item_ids, fields)
     
     
-    async def search(self, keywords: List[SearchKeyword], skip=0) -> List[SettingList]:
-        return await super().search(keywords, skip)
+    async def search(self, keywords: List[SearchKeyword], skip=0, limit=MAX_QUERY_LENGTH) -> List[SettingList]:
+        return await super().search(keywords, skip, limit)
 
 
     async def get(self, key: str, field = 'key'):
@@ -78,4 +84,9 @@ setting_service = SettingService(ServiceBaseConfig(**{
     "py_list_class": SettingList,
     "py_master_class": Setting,
     "mongodb_client": MongoDbClient(),
+    "indexes": [
+        IndexModel('key', name='key'),
+    ],
+    "search_fields": ['group', 'key'],
+    "local_cache": True
 }))
\ No newline at end of file
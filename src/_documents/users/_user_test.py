@@ -18,7 +18,7 @@ async def caching(user_service: UserService):
     users = await user_service.cache_get_all()
     assert len(users) == 0
 
-    limit = 1
+    limit = 3
     out: dict = await user_service.fetch(limit=limit)
     users = out.get('data')
     assert len(users) == limit
@@ -26,6 +26,14 @@ async def caching(user_service: UserService):
     users = await user_service.cache_get_all()
     assert len(users) == limit
 
+    # lookup keeps the requested order, drops duplicates and invalid ids and counts hits/misses
+    hits = user_service.cache_stats['hits']
+    ids = [x.id for x in users]
+    shuffled = [ids[1], ids[2], 'invalid', ids[1], ids[0]]
+    items = await user_service.cache_lookup(shuffled)
+    assert [x.id for x in items] == [ids[1], ids[2], ids[0]]
+    assert user_service.cache_info()['hits'] == hits + len(ids)
+
     await user_service.cache_delete([x.id for x in users])
     users = await user_service.cache_get_all()
     assert len(users) == 0
@@ -12,6 +12,9 @@ class Role(ExtendedEnum):
 
 USER_STATUS = ['pending', 'active', 'inactive', 'locked', 'deleted']
 
+# The attributes read from the cache to authorize a request
+ACCESS_FIELDS = ['roles', 'status']
+
 USER_GENDER = ['Male', 'Female', 'Other']
 
 BILLING_PROVIDER = ['Paypal', 'Visacard', 'Mastercard', 'Bank']
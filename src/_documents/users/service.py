@@ -6,6 +6,7 @@ from bson import ObjectId
 from fastapi import BackgroundTasks, Depends, HTTPException, Query, Request
 from fastapi.security import OAuth2PasswordBearer
 from passlib.hash import pbkdf2_sha256
+from pymongo import IndexModel
 
 from _documents._base.schema import ServiceBaseConfig
 from _documents._base.service import BaseService
@@ -36,20 +37,36 @@ class UserService(BaseService):
         return pbkdf2_sha256.verify(password, hash)
 
     
-    async def parse_token_bearer(self, access_token: str = Depends(oauth2_scheme)):
+    async def token_user(self, access_token: str, fields: List[str] | None = None) -> UserAccess:
         '''
-        Return the user decoded in the jwt token
+        Return the active user decoded in the jwt token, with only the `fields` read from the cache
+        when given
         '''
         user_id = decode_token(access_token, 'id')
         access_role = decode_token(access_token, 'role')
         if (
-            user := await self.cache_lookup(ObjectId(user_id))
+            user := await self.cache_lookup(ObjectId(user_id), fields)
         ) is None:
             raise CREDENTIALS_EXCEPTION
         if user.status != "active": raise CREDENTIALS_EXCEPTION
         return UserAccess(**user.dict(), access_role=access_role)
 
 
+    async def parse_token_bearer(self, access_token: str = Depends(oauth2_scheme)):
+        '''
+        Return the user decoded in the jwt token
+        '''
+        return await self.token_user(access_token)
+
+
+    async def parse_token_access(self, access_token: str = Depends(oauth2_scheme)):
+        '''
+        Return the roles and status of the user decoded in the jwt token, the other attributes are
+        not read from the cache
+        '''
+        return await self.token_user(access_token, ACCESS_FIELDS)
+
+
     async def parse_token_query(self, access_token: str | None = Query(default=None)):
         user_id = decode_token(access_token, 'id')
         return await self.cache_lookup(ObjectId(user_id))
@@ -86,12 +103,12 @@ class UserService(BaseService):
         return await super().find(query, select, sort)
 
 
-    async def find_many(self, query, select=None, sort=None, limit=None, skip=None) -> List[UserList]:
-        return await super().find_many(query, select, sort, limit, skip)
+    async def find_many(self, query, select=None, sort=None, limit=None, skip=None, cursor=None) -> List[UserList]:
+        return await super().find_many(query, select, sort, limit, skip, cursor)
     
 
-    async def cache_lookup(self, item_ids: ObjectId | List[ObjectId]) -> UserList | List[UserList]:
-        return await super().cache_lookup(item_ids)
+    async def cache_lookup(self, item_ids: ObjectId | List[ObjectId], fields: List[str] | None = None) -> UserList | List[UserList]:
+        return await super().cache_lookup(item_ids, fields)
 
 
     # UPDATE
@@ -148,7 +165,16 @@ user_service = UserService(ServiceBaseConfig(**{
     "py_list_class": UserList,
     "py_master_class": User,
     "mongodb_client": MongoDbClient(),
-    "record_status": USER_STATUS
+    "record_status": USER_STATUS,
+    "search_fields": ['email', 'name', 'display_name'],
+    "local_cache": True,
+    "cache_layout": "hash",
+    "cache_lock": True,
+    "indexes": [
+        IndexModel('email', name='email'),
+        IndexModel('verify_token', name='verify_token'),
+        IndexModel([('created_at', -1), ('_id', -1)], name='created_at'),
+    ]
 }))
 
 user_services = {
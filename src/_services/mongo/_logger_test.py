@@ -0,0 +1,57 @@
+from fastapi import APIRouter, Depends, FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+import pytest
+from _documents.logs.schema import Action
+from _documents.logs.service import logging_service
+from _documents.users.schema import UserList
+from _documents.users.service import user_service
+from _services.mongo.logger import MongoDbLogger
+
+
+router = APIRouter()
+
+
+@router.get("/profile", dependencies=[
+    Depends(MongoDbLogger(call_type='test'))
+])
+async def get_profile(user: UserList = Depends(user_service.parse_token_bearer)):
+    return {'id': str(user.id)}
+
+
+@router.get("/missing", dependencies=[
+    Depends(MongoDbLogger(call_type='test'))
+])
+async def get_missing():
+    raise HTTPException(status_code=404, detail="Not found.")
+
+
+@router.get("/ok", dependencies=[
+    Depends(MongoDbLogger(call_type='test'))
+])
+async def get_ok():
+    return {'ok': True}
+
+
+@pytest.fixture
+def actions(monkeypatch) -> list:
+    actions = []
+    async def create(action: Action):
+        actions.append(action)
+    monkeypatch.setattr(logging_service, 'create', create)
+    return actions
+
+
+def test_logger_outcomes(actions: list):
+    app = FastAPI()
+    app.include_router(router)
+    client = TestClient(app)
+
+    # rejected by the token dependency, failing in the handler, then handled
+    assert client.get('/profile').status_code == 401
+    assert client.get('/missing', params={'q': 1}).status_code == 404
+    assert client.get('/ok').status_code == 200
+
+    assert [(x.path, x.call_type) for x in actions] == [('/profile', 'test'), ('/missing', 'test'), ('/ok', 'test')]
+    assert actions[1].query_params == {'q': '1'}
+    assert all(x.user_id is None for x in actions)
@@ -1,21 +1,126 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReadPreference, monitoring
+from pymongo.read_concern import ReadConcern
+
 from config.settings import *
 from utils.logger import logger
 
+# Collection name: database
+COLLECTIONS = {
+    'users': 'Accounts',
+    'reset-token': 'Accounts',
+    'reset_token': 'Accounts',
+    'notification': 'Accounts',
+    'notification_inbox': 'Accounts',
+    'logs': 'Accounts',
+    'log_actions': 'Accounts',
+    'log_rollups': 'Accounts',
+    'settings': 'Settings',
+}
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    '''
+    Count the connection pool events of the client
+    '''
+    def __init__(self):
+        self.open = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures = {}
+        self.clears = 0
+
+    def connection_created(self, event):
+        self.open += 1
+
+    def connection_closed(self, event):
+        self.open -= 1
+
+    def connection_checked_out(self, event):
+        self.checkouts += 1
+        self.checked_out += 1
+        self.max_checked_out = max(self.max_checked_out, self.checked_out)
+
+    def connection_checked_in(self, event):
+        self.checked_out -= 1
+
+    def connection_check_out_failed(self, event):
+        self.checkout_failures[event.reason] = self.checkout_failures.get(event.reason, 0) + 1
+
+    def pool_cleared(self, event):
+        self.clears += 1
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_check_out_started(self, event): pass
+
+    def dict(self):
+        return {
+            'open': self.open,
+            'checked_out': self.checked_out,
+            'max_checked_out': self.max_checked_out,
+            'checkouts': self.checkouts,
+            'checkout_failures': self.checkout_failures,
+            'pool_cleared': self.clears,
+        }
+
 
 class MongoDbClient():
+    '''
+    Process-wide client, the connection pool is created on first use
+    '''
     def __new__(cls):
         if not hasattr(cls, 'instance'):
             cls.instance = super(MongoDbClient, cls).__new__(cls)
+            cls.instance._conn = None
+            cls.instance.metrics = PoolMetrics()
         return cls.instance
-    
-    def __init__(self):
-        self.conn = AsyncIOMotorClient(MONGODB_CONN_STR)
-        self.accounts = self.conn['Accounts']
-        self.settings = self.conn['Settings']
+
+    @property
+    def conn(self) -> AsyncIOMotorClient:
+        if self._conn is None:
+            self._conn = AsyncIOMotorClient(
+                MONGODB_CONN_STR,
+                maxPoolSize=MONGODB_MAX_POOL_SIZE,
+                minPoolSize=MONGODB_MIN_POOL_SIZE,
+                maxIdleTimeMS=MONGODB_MAX_IDLE_TIME_MS,
+                waitQueueTimeoutMS=MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+                **({'compressors': MONGODB_COMPRESSORS} if MONGODB_COMPRESSORS else {}),
+                event_listeners=[self.metrics]
+            )
+        return self._conn
+
+    @property
+    def accounts(self):
+        return self.conn['Accounts']
+
+    @property
+    def settings(self):
+        return self.conn['Settings']
+
+    async def startup(self):
+        '''
+        Open the connection pool and check the server is reachable
+        '''
+        try:
+            await self.conn.admin.command('ping')
+            logger.info("[MongoDB] Connected")
+        except Exception as e:
+            logger.error(f"[MongoDB] Unable to connect to the server: {e}")
+
+    def shutdown(self):
+        '''
+        Close the connection pool, it is opened again on the next use
+        '''
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
 
     def disconnect(self):
-        self.conn.close()
+        self.shutdown()
 
     async def get_server_info(self, db: str):
         '''
@@ -25,11 +130,59 @@ class MongoDbClient():
             return await getattr(self, db).server_info()
         except Exception:
             raise Exception("Unable to connect to the server.")
+
+    def get_pool_stats(self):
+        '''
+        Get the connection pool settings and usage
+        '''
+        return {
+            'max_pool_size': MONGODB_MAX_POOL_SIZE,
+            'min_pool_size': MONGODB_MIN_POOL_SIZE,
+            **self.metrics.dict(),
+        }
+
+    async def profile_collscans(self):
+        '''
+        Record the queries that scan a whole collection in the profiler of every database
+        '''
+        for db in [self.accounts, self.settings]:
+            try:
+                await db.command('profile', 1, filter={'planSummary': 'COLLSCAN'})
+            except Exception as e:
+                logger.warning(f"[Profiler] Unable to profile {db.name}: {e}")
+
+    async def get_collscans(self):
+        '''
+        Group the collection scans recorded by the profiler by collection and query fields
+        '''
+        report = []
+        for db in [self.accounts, self.settings]:
+            async for doc in db['system.profile'].aggregate([
+                {'$match': {'planSummary': 'COLLSCAN'}},
+                {'$group': {
+                    '_id': {
+                        'ns': '$ns', 'op': '$op',
+                        'fields': {'$map': {
+                            'input': {'$objectToArray': {'$ifNull': ['$command.filter', {}]}},
+                            'in': '$$this.k'
+                        }}
+                    },
+                    'count': {'$sum': 1},
+                    'millis': {'$sum': '$millis'},
+                    'last_seen': {'$max': '$ts'}
+                }},
+                {'$sort': {'count': -1}}
+            ]):
+                report.append({**doc.pop('_id'), **doc, 'last_seen': str(doc['last_seen'])})
+        return report
     
     def get_docs(self, name: str):
-        if name in ['users', 'reset-token', 'notification', 'logs']:
-            return self.accounts[name]
-        if name in ['settings']:
-            return self.settings[name]
-        return None
+        if (db := COLLECTIONS.get(name)) is None:
+            return None
+        if name in MONGODB_SECONDARY_READS:
+            # Read-heavy collections that tolerate stale reads
+            return self.conn[db].get_collection(
+                name, read_preference=ReadPreference.SECONDARY_PREFERRED, read_concern=ReadConcern('local')
+            )
+        return self.conn[db][name]
     
@@ -1,10 +1,9 @@
 import json
 
-from fastapi import Depends, Request
+from fastapi import Request
 
 from _documents.logs.service import logging_service
-from _documents.users.schema import UserList
-from _documents.users.service import user_service
+from auth.jwt import decode_payload
 from config.settings import *
 from utils.logger import logger
 
@@ -23,8 +22,35 @@ class MongoDbLogger():
         self.call_type = kwargs['call_type']
     
 
-    async def __call__(self, request: Request, user: UserList = Depends(user_service.parse_token_query)):
-        return await logging_service.request_create(self.call_type, request, user)
+    async def __call__(self, request: Request):
+        """
+        > Log the request once it is handled, whatever the outcome, so the requests rejected by the
+        other dependencies or failing in the handler are logged too. Only a body smaller than
+        `LOG_BODY_MAX_SIZE` is read, and the user is taken from the claims of the token without
+        looking it up
+        """
+        body = b''
+        if 0 < int(request.headers.get('content-length') or 0) < LOG_BODY_MAX_SIZE:
+            body = await request.body()
+        try:
+            yield
+        finally:
+            await logging_service.request_create(
+                self.call_type, request, None, body=body, **self.token_user(request)
+            )
+
+
+    @staticmethod
+    def token_user(request: Request) -> dict:
+        if (token := request.query_params.get('access_token')) is None:
+            scheme, _, token = (request.headers.get('authorization') or '').partition(' ')
+            if scheme.lower() != 'bearer' or not token: return {}
+        try:
+            payload = decode_payload(token)
+        except Exception:
+            # Invalid or expired tokens are logged without a user
+            return {}
+        return {'user_id': payload.get('id'), 'user_email': payload.get('email')}
 
 
     # async def create(self, request: Request, user: UserList):
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import time
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+
+from _documents.users.schema import UserList
+from _services.redis.codec import JsonCodec, get_codec
+from _services.redis.service import LocalCache, RedisClient
+from config.settings import LOCAL_CACHE_CHANNEL
+from config.conftest import *
+from utils.helper import get_instance
+from utils.logger import logger
+from utils.schema import encode_json
+
+
+CODECS = ['json', 'msgpack']
+
+
+def codec_instance(name: str):
+    if name == 'msgpack': pytest.importorskip('msgpack')
+    return get_codec(name)
+
+
+def run_codec(codec, records, native_types: bool):
+    """
+    > Round-trip the records through a codec the way `cache_update` and `cache_get_keys` do,
+    the pydantic parsing is timed separately as it depends on the decoded types
+    """
+    data = [x.dict() for x in records]
+    start = time.perf_counter()
+    payloads = [codec.encode(x if native_types else encode_json(x)) for x in data]
+    values = [codec.decode(x) for x in payloads]
+    codec_time = time.perf_counter() - start
+    items = [get_instance(UserList, x) for x in values]
+    total_time = time.perf_counter() - start
+    return items, codec_time, total_time, sum(len(x) for x in payloads)
+
+
+@pytest.mark.parametrize('name', CODECS)
+def test_codec_round_trip(name: str, user_documents):
+    codec = codec_instance(name)
+    doc = {
+        '_id': ObjectId(),
+        'created_at': datetime(2023, 1, 2, 3, 4, 5, 678000),
+        'nested': {
+            'ids': [ObjectId(), ObjectId()],
+            'history': [{'timestamp': [datetime(2023, 1, 1), datetime(2023, 1, 2)], 'ip': '127.0.0.1'}],
+            'amount': 1.5, 'count': 3, 'none': None, 'flag': True,
+        },
+    }
+    value = doc if codec.native_types else encode_json(doc)
+    assert codec.decode(codec.encode(value)) == value
+    if codec.native_types:
+        # The types are kept, the cache needs no pydantic parsing to restore them
+        decoded = codec.decode(codec.encode(doc))
+        assert isinstance(decoded['_id'], ObjectId)
+        assert isinstance(decoded['nested']['history'][0]['timestamp'][1], datetime)
+
+    # The records parsed back from the cache are the records written
+    records = [get_instance(UserList, x) for x in user_documents(20, 3)]
+    items, *_ = run_codec(codec, records, codec.native_types)
+    assert [encode_json(x.dict()) for x in items] == [encode_json(x.dict()) for x in records]
+    assert [x.id for x in items] == [x.id for x in records]
+
+
+@pytest.mark.asyncio
+async def test_migrate_codec(monkeypatch):
+    codec = codec_instance('msgpack')
+    client = RedisClient()
+    source = JsonCodec()
+    values = {
+        f'_test_codec:{i}': {'_id': str(ObjectId()), 'created_at': datetime(2023, 1, 2).timestamp(), 'i': i}
+        for i in range(5)
+    }
+    for k, v in values.items():
+        await client.redis.set(k, source.encode(v), ex=600)
+    await client.redis.set('_test_codec:invalid', b'\xff not json')
+    await client.redis.set('_test_other:1', source.encode({'i': -1}))
+    try:
+        monkeypatch.setattr(client, 'codec', codec)
+        assert await client.migrate_codec('json', ['_test_codec:*']) == len(values)
+
+        for k, v in values.items():
+            assert await client.get_cache(k) == v
+            assert await client.redis.exists(k) == 0
+            assert 0 < await client.redis.ttl(f'{codec.prefix}{k}') <= 600
+        # The undecodable entry and the keys outside the patterns are kept as they are
+        assert await client.redis.get('_test_codec:invalid') == b'\xff not json'
+        assert await client.redis.get('_test_other:1') == source.encode({'i': -1})
+        # A second run has nothing left to migrate
+        assert await client.migrate_codec('json', ['_test_codec:*']) == 0
+    finally:
+        await client.redis.delete(
+            *values.keys(), *[f'{codec.prefix}{k}' for k in values], '_test_codec:invalid', '_test_other:1'
+        )
+
+
+def test_local_cache_lru(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    cache = LocalCache(maxsize=3, ttl=60)
+    cache.set_many({'users:a': 1, 'users:b': 2, 'users:c': 3})
+
+    # the least recently used key is evicted first, reads count as uses
+    assert cache.get_many(['users:a']) == {'users:a': 1}
+    cache.set_many({'users:d': 4})
+    assert cache.get_many(['users:a', 'users:b', 'users:c', 'users:d']) == {'users:a': 1, 'users:c': 3, 'users:d': 4}
+
+    # the entries expire after the TTL
+    now[0] += 59
+    assert cache.get_many(['users:a']) == {'users:a': 1}
+    now[0] += 2
+    assert cache.get_many(['users:a', 'users:c']) == {}
+    assert len(cache.data) == 1
+
+    cache.delete_many(['users:d', 'users:e'])
+    assert cache.info()['documents']['users'] == {
+        'hits': 5, 'misses': 3, 'invalidations': 1, 'hit_ratio': 5 / 8
+    }
+
+
+@pytest.mark.asyncio
+async def test_local_cache_invalidation():
+    cache = LocalCache()
+    cache.set_many({'users:a': 1, 'users:b': 2, 'users:c': 3})
+    cache.start()
+    try:
+        await asyncio.sleep(0.5)
+        # the keys written by another process are dropped, the messages of this one are ignored
+        await RedisClient().publish_invalidation(['users:a'])
+        await RedisClient().redis.publish(LOCAL_CACHE_CHANNEL, json.dumps({'origin': cache.origin, 'keys': ['users:b']}))
+        for _ in range(20):
+            if 'users:a' not in cache.data: break
+            await asyncio.sleep(0.1)
+        assert cache.get_many(['users:a', 'users:b', 'users:c']) == {'users:b': 2, 'users:c': 3}
+    finally:
+        await cache.stop()
+    assert cache.listener is None
+
+
+def test_codec_benchmark(user_documents):
+    pytest.importorskip('msgpack')
+    records = [get_instance(UserList, x) for x in user_documents(200, 200)]
+
+    json_items, *json_stats = run_codec(JsonCodec(), records, False)
+    msgpack_items, *msgpack_stats = run_codec(get_codec('msgpack'), records, True)
+
+    assert [encode_json(x.dict()) for x in msgpack_items] == [encode_json(x.dict()) for x in json_items]
+    assert msgpack_items[0].login_history[0].timestamp == records[0].login_history[0].timestamp
+    for name, (codec_time, total_time, size) in [('json', json_stats), ('msgpack', msgpack_stats)]:
+        logger.info(
+            f"[Benchmark] {len(records)} users, {name}: codec {codec_time / len(records) * 1e3:.2f} ms/row, "
+            f"with parsing {total_time / len(records) * 1e3:.2f} ms/row, {size / len(records) / 1024:.1f} KB/row"
+        )
@@ -0,0 +1,104 @@
+import json
+import struct
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict
+
+from bson import ObjectId
+
+from utils.schema import encode_json
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+INT64 = struct.Struct('>q')
+
+
+class JsonCodec():
+    """
+    > The original format of the cache, JSON text with the datetimes as ISO strings. Its keys
+    have no prefix, so the entries written before the codecs were introduced stay readable
+    """
+    name = 'json'
+    prefix = ''
+    native_types = False
+
+    @staticmethod
+    def datetime_parser(dct: dict):
+        for k, v in dct.items():
+            if isinstance(v, str) and v.endswith('+00:00'):
+                try:
+                    dct[k] = datetime.fromisoformat(v)
+                except:
+                    pass
+        return dct
+
+
+    @staticmethod
+    def serialize_dates(v):
+        return v.isoformat() if isinstance(v, datetime) else v
+
+
+    def encode(self, data) -> bytes:
+        return json.dumps(data, default=self.serialize_dates).encode()
+
+
+    def decode(self, data: bytes):
+        return json.loads(data, object_hook=self.datetime_parser)
+
+
+class MsgpackCodec():
+    """
+    > A compact binary format, datetimes and ObjectIds are packed as msgpack extension types and
+    come back as the same objects, without walking the decoded values. Datetimes are stored as
+    microseconds since the epoch and decoded as naive UTC
+    """
+    name = 'msgpack'
+    prefix = 'mp1:'
+    native_types = True
+
+    EXT_DATETIME = 1
+    EXT_OBJECT_ID = 2
+
+    def __init__(self) -> None:
+        # msgpack is only required when the codec is selected
+        try:
+            import msgpack
+        except ImportError:
+            raise ImportError("The msgpack codec needs the msgpack extra: poetry install -E msgpack")
+        self.msgpack = msgpack
+
+
+    def default(self, v):
+        if isinstance(v, datetime):
+            if v.tzinfo is not None: v = v.astimezone(timezone.utc).replace(tzinfo=None)
+            return self.msgpack.ExtType(self.EXT_DATETIME, INT64.pack((v - EPOCH) // MICROSECOND))
+        if isinstance(v, ObjectId):
+            return self.msgpack.ExtType(self.EXT_OBJECT_ID, v.binary)
+        return encode_json(v)
+
+
+    def ext_hook(self, code: int, data: bytes):
+        if code == self.EXT_DATETIME:
+            return EPOCH + timedelta(microseconds=INT64.unpack(data)[0])
+        if code == self.EXT_OBJECT_ID:
+            return ObjectId(data)
+        return self.msgpack.ExtType(code, data)
+
+
+    def encode(self, data) -> bytes:
+        return self.msgpack.packb(data, default=self.default)
+
+
+    def decode(self, data: bytes):
+        return self.msgpack.unpackb(data, ext_hook=self.ext_hook)
+
+
+CODECS: Dict[str, Any] = {
+    JsonCodec.name: JsonCodec,
+    MsgpackCodec.name: MsgpackCodec,
+}
+
+
+def get_codec(name: str):
+    if name not in CODECS:
+        raise ValueError(f"Unknown Redis codec '{name}', expected one of {list(CODECS.keys())}")
+    return CODECS[name]()
@@ -1,78 +1,628 @@
-
+import asyncio
 import json
-from datetime import datetime
-from typing import Dict, List
+import random
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Dict, List
 
 import aioredis
+from aioredis.client import Pipeline, PubSub
 
-from config.settings import REDIS_URL
+from config.settings import (LOCAL_CACHE_CHANNEL, LOCAL_CACHE_SIZE,
+                             LOCAL_CACHE_TTL, REDIS_CODEC,
+                             REDIS_CONNECT_TIMEOUT, REDIS_MAX_CONNECTIONS,
+                             REDIS_POOL_TIMEOUT, REDIS_SCAN_COUNT,
+                             REDIS_SOCKET_TIMEOUT, REDIS_URL)
 from utils.logger import logger
 
+from .codec import get_codec
+
+RELEASE_LOCKS_SCRIPT = """
+local released = 0
+for _, key in ipairs(KEYS) do
+    if redis.call('get', key) == ARGV[1] then
+        released = released + redis.call('del', key)
+    end
+end
+return released
+"""
+
+# Write a hash only when its key is missing, ARGV holds the TTL, 0 for none, then the fields and values
+SET_HASH_NX_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then return 0 end
+redis.call('hset', KEYS[1], unpack(ARGV, 2))
+if tonumber(ARGV[1]) > 0 then redis.call('expire', KEYS[1], ARGV[1]) end
+return 1
+"""
+
+# The pipeline opened by `RedisClient.pipeline` in the current task, the writes are queued on it
+current_pipeline: ContextVar[Pipeline | None] = ContextVar('current_pipeline', default=None)
+
+
+class RedisMetrics():
+    '''
+    Count the commands, their latency and the connection checkouts of the client
+    '''
+    def __init__(self):
+        self.commands = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.checkouts = 0
+        self.pool_waits = 0
+        self.pool_exhausted = 0
+
+    @asynccontextmanager
+    async def track(self):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.in_flight -= 1
+            self.commands += 1
+            self.latency_total += elapsed
+            self.latency_max = max(self.latency_max, elapsed)
+
+    def dict(self):
+        return {
+            'commands': self.commands,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'latency_avg_ms': self.latency_total / self.commands * 1000 if self.commands > 0 else None,
+            'latency_max_ms': self.latency_max * 1000,
+            'checkouts': self.checkouts,
+            'pool_waits': self.pool_waits,
+            'pool_exhausted': self.pool_exhausted,
+        }
+
+
+class MeteredConnectionPool(aioredis.BlockingConnectionPool):
+    '''
+    Blocking pool counting the checkouts that had to wait for a connection, and the ones that
+    timed out after `REDIS_POOL_TIMEOUT`
+    '''
+    metrics: RedisMetrics
+
+    async def get_connection(self, command_name, *keys, **options):
+        self.metrics.checkouts += 1
+        if self.pool.empty(): self.metrics.pool_waits += 1
+        try:
+            return await super().get_connection(command_name, *keys, **options)
+        except aioredis.ConnectionError:
+            if self.pool.empty(): self.metrics.pool_exhausted += 1
+            raise
+
+
+class MeteredPipeline(Pipeline):
+    metrics: RedisMetrics
+
+    async def execute(self, raise_on_error: bool = True):
+        async with self.metrics.track():
+            return await super().execute(raise_on_error)
+
+
+class MeteredRedis(aioredis.Redis):
+    metrics: RedisMetrics
+
+    async def execute_command(self, *args, **options):
+        async with self.metrics.track():
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint: str | None = None) -> MeteredPipeline:
+        pipe = MeteredPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.metrics = self.metrics
+        return pipe
+
+
 class RedisClient():
+    '''
+    Process-wide client, the connection pool is created on first use
+    '''
     def __new__(cls):
         if not hasattr(cls, 'instance'):
             cls.instance = super(RedisClient, cls).__new__(cls)
+            cls.instance._redis = None
+            cls.instance._pubsub_redis = None
+            cls.instance.codec = get_codec(REDIS_CODEC)
+            cls.instance.metrics = RedisMetrics()
         return cls.instance
+
+    @property
+    def redis(self) -> MeteredRedis:
+        if self._redis is None:
+            # Values are binary with the msgpack codec, keys are decoded by `scan_keys`
+            pool = MeteredConnectionPool.from_url(
+                REDIS_URL,
+                decode_responses=False,
+                max_connections=REDIS_MAX_CONNECTIONS,
+                timeout=REDIS_POOL_TIMEOUT,
+                socket_timeout=REDIS_SOCKET_TIMEOUT,
+                socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+                retry_on_timeout=True
+            )
+            pool.metrics = self.metrics
+            self._redis = MeteredRedis(connection_pool=pool)
+            self._redis.metrics = self.metrics
+        return self._redis
+
+    def pubsub(self) -> PubSub:
+        '''
+        Subscriptions have their own connections, without the socket timeout of the pool: a
+        subscriber waits for messages as long as the channel stays quiet
+        '''
+        if self._pubsub_redis is None:
+            self._pubsub_redis = aioredis.from_url(
+                REDIS_URL, decode_responses=False, socket_connect_timeout=REDIS_CONNECT_TIMEOUT
+            )
+        return self._pubsub_redis.pubsub()
+
+    async def shutdown(self):
+        '''
+        Close the connection pools, they are opened again on the next use
+        '''
+        if self._redis is not None:
+            await self._redis.close()
+            await self._redis.connection_pool.disconnect()
+            self._redis = None
+        if self._pubsub_redis is not None:
+            await self._pubsub_redis.connection_pool.disconnect()
+            self._pubsub_redis = None
+
+    def get_pool_stats(self) -> dict:
+        return {
+            'max_connections': REDIS_MAX_CONNECTIONS,
+            'connections': len(self._redis.connection_pool._connections) if self._redis is not None else 0,
+            **self.metrics.dict()
+        }
+
+
+    @asynccontextmanager
+    async def pipeline(self, transaction: bool = False) -> AsyncIterator[Pipeline]:
+        """
+        > Batch the cache writes in one round trip. Inside the context, `set_keys`, `delete_cache`
+        and `publish_invalidation` are queued on a shared pipeline, executed when the context exits.
+        A nested context joins the outer one
+        
+        :param transaction: Wrap the queued commands in MULTI/EXEC
+        :return: The pipeline, more commands can be queued on it
+        """
+        if (pipe := current_pipeline.get()) is not None:
+            yield pipe
+            return
+        async with self.redis.pipeline(transaction=transaction) as pipe:
+            token = current_pipeline.set(pipe)
+            try:
+                yield pipe
+            finally:
+                current_pipeline.reset(token)
+            if len(pipe) > 0: await pipe.execute()
+
+
+    def key(self, key: str) -> str:
+        return f'{self.codec.prefix}{key}'
+
+
+    def serialize_values(self, data: bytes):
+        return self.codec.decode(data)
     
-    def __init__(self) -> None:
-        self.redis = aioredis.from_url(REDIS_URL, decode_responses=True)
-
-
-    def serialize_values(self, data: str):
-        def datetime_parser(dct: dict):
-            for k, v in dct.items():
-                if isinstance(v, str) and v.endswith('+00:00'):
-                    try:
-                        dct[k] = datetime.fromisoformat(v)
-                    except:
-                        pass
-            return dct
-        return json.loads(data, object_hook=datetime_parser)
-    
 
-    async def set_cache(self, data, key: str):
-        def serialize_dates(v):
-            return v.isoformat() if isinstance(v, datetime) else v
-        await self.redis.set(
-            key,
-            json.dumps(data, default=serialize_dates),
-        )
+    async def set_cache(self, data, key: str, ex: int | None = None):
+        await self.redis.set(self.key(key), self.codec.encode(data), ex=ex)
+
+
+    async def set_cache_raw(self, payload: bytes, key: str, ex: int | None = None):
+        """
+        > Write a value already encoded with `codec`
+        """
+        await self.redis.set(self.key(key), payload, ex=ex)
     
 
     async def get_cache(self, key: str):
-        data: str = await self.redis.get(key)
+        data: bytes = await self.redis.get(self.key(key))
         if data is None: return None
         return self.serialize_values(data)
         
 
-    async def set_keys(self, data: Dict[str, str]):
-        def serialize_dates(v):
-            return v.isoformat() if isinstance(v, datetime) else v
-        await self.redis.mset({ 
-            k: json.dumps(v, default=serialize_dates) for k, v in data.items() 
-        })
+    async def set_keys(self, data: Dict[str, Any], ex: int | None = None, jitter: float = 0, nx: bool = False):
+        """
+        > Write several keys at once, with `ex` the keys are written with SET EX in a single
+        MULTI/EXEC transaction so no key is left without expiry. Inside `pipeline`, the writes are
+        queued on the shared pipeline instead
+        
+        :param data: The values by key
+        :param ex: The TTL in seconds, None writes the keys with MSET and no expiry
+        :param jitter: A random extra fraction of `ex` added to each key, so keys written together
+        do not expire together
+        :param nx: Only write the keys that do not exist
+        """
+        async with self.pipeline(transaction=ex is not None or nx) as pipe:
+            if ex is None and not nx:
+                pipe.mset({ 
+                    self.key(k): self.codec.encode(v) for k, v in data.items() 
+                })
+            else:
+                for k, v in data.items():
+                    pipe.set(
+                        self.key(k), self.codec.encode(v),
+                        ex=ex + int(random.random() * jitter * ex) if ex is not None else None, nx=nx
+                    )
 
 
     async def get_keys(self, keys: str | List[str]):
         is_single = not isinstance(keys, list)
         if is_single:
-            data: str = await self.redis.get(keys)
+            data: bytes = await self.redis.get(self.key(keys))
             return self.serialize_values(data)
         else:
-            data: List[str] = [x for x in await self.redis.mget(keys)
-                               if x is not None]
+            data: List[bytes] = [x for x in await self.redis.mget([self.key(k) for k in keys])
+                                 if x is not None]
             return [self.serialize_values(x) for x in data]
 
 
+    async def set_hashes(self, data: Dict[str, Dict[str, Any]], ex: int | None = None, jitter: float = 0, nx: bool = False):
+        """
+        > Write several records as hashes, one field per attribute, so a subset of the attributes
+        can be read back with HMGET. Queued on the shared pipeline inside `pipeline`
+        
+        :param data: The records by key
+        :param ex: The TTL in seconds, None keeps the keys until deleted
+        :param jitter: A random extra fraction of `ex` added to each key
+        :param nx: Only write the records whose key does not exist
+        """
+        async with self.pipeline(transaction=True) as pipe:
+            for k, v in data.items():
+                if nx:
+                    pipe.eval(
+                        SET_HASH_NX_SCRIPT, 1, self.key(k),
+                        ex + int(random.random() * jitter * ex) if ex is not None else 0,
+                        *[y for f, x in v.items() for y in (f, self.codec.encode(x))]
+                    )
+                    continue
+                # Replaced as a whole, no field of the previous record is left
+                pipe.delete(self.key(k))
+                pipe.hset(self.key(k), mapping={f: self.codec.encode(x) for f, x in v.items()})
+                if ex is not None: pipe.expire(self.key(k), ex + int(random.random() * jitter * ex))
+
+
+    async def get_hashes(self, keys: List[str], fields: List[str] | None = None, id_field: str = 'id') -> List[dict]:
+        """
+        > Read records written by `set_hashes`, with HGETALL or only the given fields with HMGET, in
+        one pipeline. Missing keys are left out
+        
+        :param keys: The keys of the records
+        :param fields: The attributes to read, all of them by default
+        :param id_field: An attribute every record has, tells a missing key from missing fields
+        :return: A list of dictionaries
+        """
+        if len(keys) == 0: return []
+        if fields is not None: fields = list(dict.fromkeys([id_field, *fields]))
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for k in keys:
+                if fields is None: pipe.hgetall(self.key(k))
+                else: pipe.hmget(self.key(k), fields)
+            results = await pipe.execute()
+        if fields is None:
+            return [
+                {f.decode(): self.serialize_values(v) for f, v in x.items()} for x in results if len(x) > 0
+            ]
+        return [
+            {f: self.serialize_values(v) for f, v in zip(fields, x) if v is not None}
+            for x in results if x[0] is not None
+        ]
+
+
+    async def incr_keys(self, keys: List[str], ex: int):
+        """
+        > Increment integer keys and renew their TTL, queued on the shared pipeline inside `pipeline`
+        """
+        if len(keys) == 0: return
+        async with self.pipeline() as pipe:
+            for k in keys: pipe.incr(self.key(k)).expire(self.key(k), ex)
+
+
+    async def get_counters(self, keys: List[str]) -> List[int]:
+        return [int(x or 0) for x in await self.redis.mget([self.key(k) for k in keys])]
+
+
+    async def set_field(self, key: str, field: str, data, ex: int | None = None):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(self.key(key), field, self.codec.encode(data))
+            if ex is not None: pipe.expire(self.key(key), ex)
+            await pipe.execute()
+
+
+    async def get_field(self, key: str, field: str):
+        data: bytes = await self.redis.hget(self.key(key), field)
+        if data is None: return None
+        return self.serialize_values(data)
+
+
+    async def scan_keys(self, pattern: str, count: int = REDIS_SCAN_COUNT, prefix: str | None = None) -> AsyncIterator[List[str]]:
+        """
+        > Iterate the keys matching a pattern with SCAN, one batch of keys per cursor step. The server
+        is never blocked over the whole keyspace, a key may be repeated if the keyspace is resized
+        during the scan
+        
+        :param pattern: The glob-style pattern
+        :param count: The COUNT hint of each SCAN call
+        :param prefix: The key prefix to scan, the one of the current codec by default
+        :return: An async iterator of lists of keys, without their prefix
+        """
+        if prefix is None: prefix = self.codec.prefix
+        cursor = 0
+        while True:
+            cursor, keys = await self.redis.scan(cursor, match=f'{prefix}{pattern}', count=count)
+            if len(keys) > 0: yield [x.decode()[len(prefix):] for x in keys]
+            if cursor == 0: break
+
+
+    async def iter_pattern(self, pattern: str, count: int = REDIS_SCAN_COUNT, hashes: bool = False) -> AsyncIterator[List[Any]]:
+        async for keys in self.scan_keys(pattern, count):
+            yield await (self.get_hashes(keys) if hashes else self.get_keys(keys))
+
+
     async def get_pattern(self, pattern: str):
-        keys = await self.redis.keys(pattern)
-        return await self.get_keys(keys)
+        return [x async for values in self.iter_pattern(pattern) for x in values]
 
 
     async def delete_cache(self, *args):
-        await self.redis.delete(*args)
+        if (pipe := current_pipeline.get()) is not None:
+            pipe.delete(*[self.key(k) for k in args])
+            return None
+        return await self.redis.delete(*[self.key(k) for k in args])
 
     
-    async def delete_pattern(self, pattern):
-        async for k in self.redis.scan_iter(pattern):
-            await self.redis.delete(k)
\ No newline at end of file
+    async def delete_pattern(self, pattern, count: int = REDIS_SCAN_COUNT):
+        deleted = 0
+        async for keys in self.scan_keys(pattern, count):
+            deleted += await self.redis.unlink(*[self.key(k) for k in keys])
+        return deleted
+
+
+    async def acquire_locks(self, keys: List[str], token: str, px: int) -> List[str]:
+        """
+        > Try to take a lock on each key with SET NX PX, in one pipeline
+        
+        :param keys: The lock keys
+        :param token: The value identifying the owner, needed to release the locks
+        :param px: The expiry of the locks in milliseconds
+        :return: The keys that were locked
+        """
+        if len(keys) == 0: return []
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for k in keys: pipe.set(self.key(k), token, nx=True, px=px)
+            result = await pipe.execute()
+        return [k for k, locked in zip(keys, result) if locked]
+
+
+    async def release_locks(self, keys: List[str], token: str):
+        if len(keys) == 0: return
+        # Only the locks still owned are deleted, an expired lock may have been taken by another worker
+        await self.redis.eval(RELEASE_LOCKS_SCRIPT, len(keys), *[self.key(k) for k in keys], token)
+
+
+    async def held_locks(self, keys: List[str]) -> List[str]:
+        if len(keys) == 0: return []
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for k in keys: pipe.exists(self.key(k))
+            result = await pipe.execute()
+        return [k for k, held in zip(keys, result) if held]
+
+
+    async def key_stats(self, count: int = REDIS_SCAN_COUNT) -> dict:
+        """
+        > Count the keys and their memory usage by prefix, the part of the key before the first
+        `:`. Every key is visited with SCAN and one pipelined MEMORY USAGE per batch
+        
+        :param count: The COUNT hint of each SCAN call
+        :return: The used memory of the server and the key count, memory in bytes and keys without
+        expiry of each prefix
+        """
+        prefixes = {}
+        async for keys in self.scan_keys('*', count):
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for k in keys: pipe.memory_usage(self.key(k)).ttl(self.key(k))
+                meta = await pipe.execute()
+            for i, k in enumerate(keys):
+                stats = prefixes.setdefault(k.split(':')[0], {'keys': 0, 'memory': 0, 'persistent': 0})
+                stats['keys'] += 1
+                stats['memory'] += meta[2 * i] or 0
+                if meta[2 * i + 1] == -1: stats['persistent'] += 1
+        info = await self.redis.info('memory')
+        return {
+            'used_memory': info.get('used_memory'),
+            'maxmemory': info.get('maxmemory'),
+            'maxmemory_policy': info.get('maxmemory_policy'),
+            'prefixes': prefixes
+        }
+
+
+    async def migrate_codec(self, source: str, patterns: List[str], count: int = REDIS_SCAN_COUNT) -> int:
+        """
+        > Re-encode the entries written with another codec into the current one, keeping their
+        remaining TTL, and delete the old entries. Only the keys matching the patterns are scanned,
+        as the JSON codec has no prefix and the Redis may be shared. The entries that do not decode
+        with the source codec, and the keys that are not strings or hashes, are left as they are
+        
+        :param source: The name of the codec the entries were written with
+        :param patterns: The glob-style patterns of the keys to migrate, without prefix
+        :param count: The COUNT hint of each SCAN call
+        :return: The number of migrated keys
+        """
+        source = get_codec(source)
+        if source.prefix == self.codec.prefix: return 0
+        migrated = 0
+        for pattern in patterns:
+            async for keys in self.scan_keys(pattern, count, prefix=source.prefix):
+                keys = [k for k in keys if not (source.prefix + k).startswith(self.codec.prefix)]
+                if len(keys) == 0: continue
+                old_keys = [f'{source.prefix}{k}' for k in keys]
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for k in old_keys: pipe.type(k).pttl(k)
+                    meta = await pipe.execute()
+                values = await self.redis.mget(old_keys)
+                done = []
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for i, k in enumerate(keys):
+                        key_type, ttl = meta[2 * i], meta[2 * i + 1]
+                        try:
+                            if key_type == b'string' and values[i] is not None:
+                                pipe.set(self.key(k), self.codec.encode(source.decode(values[i])), px=ttl if ttl > 0 else None)
+                            elif key_type == b'hash':
+                                fields = {
+                                    f: self.codec.encode(source.decode(v))
+                                    for f, v in (await self.redis.hgetall(old_keys[i])).items()
+                                }
+                                pipe.hset(self.key(k), mapping=fields)
+                                if ttl > 0: pipe.pexpire(self.key(k), ttl)
+                            else:
+                                continue
+                        except Exception as e:
+                            logger.warning(f"[Redis] Key {old_keys[i]} is not a {source.name} entry, kept as is: {e}")
+                            continue
+                        done.append(old_keys[i])
+                    if len(done) > 0:
+                        pipe.unlink(*done)
+                        await pipe.execute()
+                migrated += len(done)
+        return migrated
+
+
+    async def publish_invalidation(self, keys: List[str]):
+        """
+        > Tell the other processes to drop the given keys from their local cache
+        
+        :param keys: The cache keys that were written or deleted
+        """
+        if len(keys) == 0: return
+        async with self.pipeline() as pipe:
+            pipe.publish(LOCAL_CACHE_CHANNEL, json.dumps({
+                'origin': local_cache.origin,
+                'keys': keys
+            }))
+
+
+class LocalCache():
+    """
+    > A bounded, per-process LRU cache of already parsed records kept in front of Redis. Entries
+    expire after `ttl` seconds, and are dropped in every process when a key is written or deleted,
+    through the `LOCAL_CACHE_CHANNEL` pub/sub channel
+    """
+    def __init__(self, maxsize: int = LOCAL_CACHE_SIZE, ttl: int = LOCAL_CACHE_TTL) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.origin = uuid.uuid4().hex
+        self.data: OrderedDict[str, tuple] = OrderedDict()
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self.listener: asyncio.Task | None = None
+
+
+    def _count(self, key: str, event: str, n: int = 1):
+        stats = self.stats.setdefault(key.split(':')[0], {'hits': 0, 'misses': 0, 'invalidations': 0})
+        stats[event] += n
+
+
+    def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        now = time.monotonic()
+        found = {}
+        for k in keys:
+            if (entry := self.data.get(k)) is not None and entry[1] > now:
+                self.data.move_to_end(k)
+                found[k] = entry[0]
+                self._count(k, 'hits')
+            else:
+                if entry is not None: del self.data[k]
+                self._count(k, 'misses')
+        return found
+
+
+    def set_many(self, data: Dict[str, Any]):
+        expires = time.monotonic() + self.ttl
+        for k, v in data.items():
+            self.data[k] = (v, expires)
+            self.data.move_to_end(k)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+
+    def delete_many(self, keys: List[str]):
+        for k in keys:
+            if self.data.pop(k, None) is not None: self._count(k, 'invalidations')
+
+
+    def clear(self, prefix: str | None = None):
+        if prefix is None:
+            self.data.clear()
+        else:
+            for k in [k for k in self.data if k.startswith(prefix)]: del self.data[k]
+
+
+    def info(self) -> Dict[str, dict]:
+        """
+        > Return the hit/miss/invalidation counters and the hit ratio of each document
+        
+        :return: A dictionary keyed by document
+        """
+        return {
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+            'documents': {
+                document: {
+                    **stats,
+                    'hit_ratio': stats['hits'] / total if (total := stats['hits'] + stats['misses']) > 0 else None
+                } for document, stats in self.stats.items()
+            }
+        }
+
+
+    async def listen(self):
+        """
+        > Drop the keys published by the other processes on the invalidation channel. A lost
+        connection clears the whole cache, since the invalidations sent meanwhile are not replayed
+        """
+        while True:
+            pubsub = RedisClient().pubsub()
+            try:
+                await pubsub.subscribe(LOCAL_CACHE_CHANNEL)
+                async for message in pubsub.listen():
+                    if message['type'] != 'message': continue
+                    data = json.loads(message['data'])
+                    if data['origin'] != self.origin: self.delete_many(data['keys'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[LocalCache] Invalidation listener failed: {e}")
+                self.clear()
+            finally:
+                # Releases the connection, it is not when the pubsub is garbage collected
+                await pubsub.reset()
+            await asyncio.sleep(1)
+
+
+    def start(self):
+        if self.listener is None: self.listener = asyncio.create_task(self.listen())
+
+
+    async def stop(self):
+        if self.listener is None: return
+        self.listener.cancel()
+        try:
+            await self.listener
+        except asyncio.CancelledError:
+            pass
+        self.listener = None
+
+
+local_cache = LocalCache()
\ No newline at end of file
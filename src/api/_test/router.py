@@ -21,6 +21,14 @@ async def get_test_verify_token(email: str):
     return JSONResponse(status_code=200, content=await ts.find_token(email))
 
 
+@router.get("/collscan", dependencies=[
+    Depends(RoleGuard([Role.DBA.value])),
+])
+async def get_collscan_report():
+    logger.info('[Test] Query the collection scans recorded in dev mode')
+    return JSONResponse(status_code=200, content=await ts.find_collscans())
+
+
 @router.post("/init/{document}", dependencies=[
     Depends(RoleGuard([Role.DBA.value])),
 ])
@@ -4,6 +4,7 @@ from _documents.logs.service import logging_service
 from _documents.notifications.service import notification_service
 from _documents.users.schema import *
 from _documents.users.service import user_service
+from _services.mongo.client import MongoDbClient
 
 
 class TestingService():
@@ -19,6 +20,10 @@ class TestingService():
         return { 'verify_token': user['verify_token'] }
 
 
+    async def find_collscans(self):
+        return { 'data': await MongoDbClient().get_collscans() }
+
+
     # helpers
     async def remove_users(self, user_ids: List[str]):
         order_ids = []
@@ -40,10 +40,11 @@ async def patch_profile(
     Depends(MongoDbLogger(call_type='account'))
 ])
 async def get_user_billing_data(
-    request: Request, user: UserList = Depends(user_service.parse_token_bearer), skip: int = 0, limit: int = 10
+    request: Request, user: UserList = Depends(user_service.parse_token_bearer), skip: int = 0, limit: int = 10,
+    cursor: str | None = None
 ):
     logger.info('Get user notifications on Gateway')
-    return JSONResponse(status_code=200, content=await get_notifications(user, skip, limit))
+    return JSONResponse(status_code=200, content=await get_notifications(user, skip, limit, cursor))
 
 
 @router.patch("/notification", dependencies=[
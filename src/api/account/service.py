@@ -42,13 +42,14 @@ async def get_billing_data(user: UserAccess, skip: int = 0):
     }
 
 
-async def get_notifications(user: UserAccess, skip: int = 0, limit: int = 10):
-    results: dict = await notification_service.fetch_user(user, skip=skip, limit=limit)
+async def get_notifications(user: UserAccess, skip: int = 0, limit: int = 10, cursor: str | None = None):
+    results: dict = await notification_service.fetch_user(user, skip=skip, limit=limit, cursor=cursor)
     return {
         'data': results.get('items'),
         'options': {
             'total_notifications': results.get('total_count'),
-            'hidden_unread_notifications': results.get('unread_count') - len([x for x in results.get('items') if x['status'] == 'UNREAD'])
+            'hidden_unread_notifications': results.get('unread_count') - len([x for x in results.get('items') if x['status'] == 'UNREAD']),
+            'next_cursor': results.get('next_cursor')
         }
     }
 
@@ -4,10 +4,12 @@ from fastapi import Depends, FastAPI
 
 from api._test.router import router as testing_router
 from api.account.router import router as account_router
+from api.health.router import router as health_router
+from api.logs.router import router as logs_router
 
 from config import crons
 from utils.logger import logger
-from _services.redis.service import RedisClient
+from _services.redis.service import local_cache
 
 
 api_app = FastAPI()
@@ -15,7 +17,7 @@ api_app = FastAPI()
 Schedule: AsyncIOScheduler = None
 
 async def startup_api():
-    await RedisClient().delete_pattern('*')
+    local_cache.start()
     # Initialize Cron Jobs
     global Schedule
     try:
@@ -36,10 +38,13 @@ async def shutdown_api():
     global Schedule
     Schedule.shutdown()
     logger.info("Disable Schedule")
+    await local_cache.stop()
 
 
 api_app.include_router(testing_router, tags=["testing"], prefix="/testing")
 api_app.include_router(account_router, tags=["account"], prefix="/account")
+api_app.include_router(health_router, tags=["health"], prefix="/health")
+api_app.include_router(logs_router, tags=["logs"], prefix="/logs")
 
 
 
@@ -0,0 +1,30 @@
+from _documents.users.schema import Role
+from fastapi import APIRouter, Depends
+from fastapi.responses import JSONResponse
+from utils.guard import RoleGuard
+from utils.logger import logger
+
+from .service import *
+
+router = APIRouter()
+
+
+@router.get("")
+async def get_health_status():
+    return JSONResponse(status_code=200, content=await get_health())
+
+
+@router.get("/stats", dependencies=[
+    Depends(RoleGuard([Role.DBA.value])),
+])
+async def get_stats_status():
+    logger.info('[Health] Query the pools, local cache and log writer stats')
+    return JSONResponse(status_code=200, content=await get_health_stats())
+
+
+@router.get("/cache", dependencies=[
+    Depends(RoleGuard([Role.DBA.value])),
+])
+async def get_cache_status():
+    logger.info('[Health] Query the Redis key counts and memory usage by prefix')
+    return JSONResponse(status_code=200, content=await get_cache_stats())
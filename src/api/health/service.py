@@ -0,0 +1,40 @@
+from _documents.logs.service import logging_service
+from _services.mongo.client import MongoDbClient
+from _services.redis.service import RedisClient, local_cache
+from utils.logger import logger
+
+
+# API
+async def get_health():
+    return {'status': 'ok'}
+
+
+async def get_health_stats():
+    try:
+        await MongoDbClient().accounts.command('ping')
+        mongodb = 'ok'
+    except Exception as e:
+        logger.error(f"[Health] MongoDB ping failed: {e}")
+        mongodb = 'unavailable'
+    try:
+        await RedisClient().redis.ping()
+        redis = 'ok'
+    except Exception as e:
+        logger.error(f"[Health] Redis ping failed: {e}")
+        redis = 'unavailable'
+    return {
+        'mongodb': {
+            'status': mongodb,
+            'pool': MongoDbClient().get_pool_stats()
+        },
+        'redis': {
+            'status': redis,
+            'pool': RedisClient().get_pool_stats()
+        },
+        'local_cache': local_cache.info(),
+        'logs': logging_service.writer_info()
+    }
+
+
+async def get_cache_stats():
+    return await RedisClient().key_stats()
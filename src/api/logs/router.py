@@ -0,0 +1,35 @@
+from datetime import datetime
+
+from _documents.users.schema import Role
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import JSONResponse
+from config.settings import MAX_FETCH_LIMIT
+from utils.guard import RoleGuard
+from utils.logger import logger
+
+from .service import *
+
+router = APIRouter()
+
+
+@router.get("/actions", dependencies=[
+    Depends(RoleGuard([Role.DBA.value])),
+])
+async def get_log_actions(
+    user_id: str | None = None, call_type: str | None = None, method: str | None = None,
+    path: str | None = None, start: datetime | None = None, end: datetime | None = None,
+    limit: int = Query(MAX_FETCH_LIMIT, ge=1, le=MAX_FETCH_LIMIT), cursor: str = ''
+):
+    logger.info('[Logs] Query the logged actions')
+    return JSONResponse(status_code=200, content=await get_actions(
+        user_id=user_id, call_type=call_type, method=method, path=path,
+        start=start, end=end, limit=limit, cursor=cursor
+    ))
+
+
+@router.get("/rollups", dependencies=[
+    Depends(RoleGuard([Role.DBA.value])),
+])
+async def get_log_rollups(start: datetime | None = None, end: datetime | None = None, group_by: str = 'call_type'):
+    logger.info('[Logs] Query the hourly action counts')
+    return JSONResponse(status_code=200, content=await get_rollups(start, end, group_by))
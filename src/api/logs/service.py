@@ -0,0 +1,13 @@
+from datetime import datetime, timedelta
+
+from _documents.logs.service import logging_service
+
+
+# API
+async def get_actions(**filters):
+    return await logging_service.find_actions(**filters)
+
+
+async def get_rollups(start: datetime | None, end: datetime | None, group_by: str):
+    if start is None: start = datetime.utcnow() - timedelta(days=1)
+    return { 'data': await logging_service.find_rollups(start, end, group_by) }
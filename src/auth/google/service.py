@@ -14,7 +14,6 @@ from _documents.users.service import user_service
 from auth.jwt import CREDENTIALS_EXCEPTION, create_token
 from auth.oauth.service import verify_token
 from config.settings import *
-from _services.mongo.client import MongoDbClient
 
 from _services.redis.service import RedisClient
 
@@ -50,7 +49,7 @@ async def create_new_user(background_tasks: BackgroundTasks, role: str,
         roles=[role],
         status='active'
     )
-    insert_result = await MongoDbClient().get_docs('user').insert_one(user_data.dict())
+    insert_result = await user_service.db_client().insert_one(user_service.search_document(user_data.dict()))
     new_user = await user_service.find({"_id": insert_result.inserted_id})
     await user_service.cache_update(new_user)
     return new_user
@@ -62,7 +61,7 @@ async def authorize_redirect(request: Request, client_id: str):
     # cache mapping client_id to google_state
     location = dict(redirect.headers).get("location")
     query = parse_qs(urlparse(location).query)
-    await RedisClient().set_cache(client_id, f"_state_google_{query['state'][0]}")
+    await RedisClient().set_cache(client_id, f"_state_google_{query['state'][0]}", ex=OAUTH_STATE_TTL)
     return redirect
 
 
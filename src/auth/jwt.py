@@ -49,8 +49,11 @@ def create_token(role: str, user: UserList):
 
 
 # Decode token
+def decode_payload(token: str) -> dict:
+    if token is None: return {}
+    return jwt.decode(token, API_SECRET_KEY, algorithms=[API_ALGORITHM])
+
+
 def decode_token(token: str, key = 'id'):
-    if token is None: return None
-    payload = jwt.decode(token, API_SECRET_KEY, algorithms=[API_ALGORITHM])
-    return payload.get(key)
+    return decode_payload(token).get(key)
 
@@ -74,9 +74,9 @@ async def register(data: UserCreate, role: str, background_tasks: BackgroundTask
             **data.dict(), roles=[role],
             verify_token=verify_token
         )
-        insert_result = await user_service.db_client().insert_one({
+        insert_result = await user_service.db_client().insert_one(user_service.search_document({
             k: v for k, v in user_data.dict().items() if v is not None
-        })
+        }))
 
         new_user: UserList = await user_service.find({"_id": insert_result.inserted_id})
         await user_service.cache_update(new_user)
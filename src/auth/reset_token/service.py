@@ -3,6 +3,8 @@ import re
 import time
 from datetime import datetime, timedelta
 
+from _documents._base.schema import ServiceBaseConfig
+from _documents._base.service import BaseService
 from _documents.users.schema import UserList
 from _documents.users.service import user_service
 from _services.smtp.schema import EmailSchema
@@ -13,13 +15,25 @@ from bson import ObjectId
 from config.settings import *
 from fastapi import Depends, HTTPException
 from passlib.hash import pbkdf2_sha256
+from pymongo import IndexModel
 
 from .schema import *
 
+reset_token_service = BaseService(ServiceBaseConfig(**{
+    "document": "reset_token",
+    "py_list_class": ResetToken,
+    "py_master_class": ResetToken,
+    "mongodb_client": MongoDbClient(),
+    "indexes": [
+        IndexModel('token', name='token'),
+        IndexModel('expired_time', name='expired_time', expireAfterSeconds=0),
+    ]
+}))
+
 
 async def validate_token(token):
     if (
-        reset_token := await MongoDbClient().get_docs('reset_token').find_one({
+        reset_token := await reset_token_service.db_client().find_one({
             "token": token, "status": True, "expired_time": {"$gte": datetime.utcnow()}
         })
     ) is None:
@@ -37,20 +51,20 @@ async def create_token(key: str, field_type: str, data = None):
         if not re.fullmatch(regex, data['new_email']):
             raise HTTPException(status_code=400, detail=f"Email {data['new_email']} is invalid.")
         if (
-            user := await MongoDbClient().get_docs('user').find_one({ 'email': data['new_email'] })
+            user := await user_service.db_client().find_one({ 'email': data['new_email'] })
         ) is not None:
             raise HTTPException(status_code=400, detail=f"Email {data['new_email']} is already registered.")
 
     # Check user not exists
     if (
-        user := await MongoDbClient().get_docs('user').find_one(
+        user := await user_service.db_client().find_one(
             { "_id": ObjectId(key) } if ObjectId.is_valid(key) else { 'email': key }
     )
     ) is None:
         raise HTTPException(status_code=400, detail=f"User {key} not found.")
 
     # Create new reset token
-    create_result = await MongoDbClient().get_docs('reset_token').insert_one(
+    create_result = await reset_token_service.db_client().insert_one(
         ResetToken(**{
             "user_id": user['_id'],
             "type": field_type.upper(),
@@ -61,7 +75,7 @@ async def create_token(key: str, field_type: str, data = None):
     )
     # Send email notification for reset token
     if (
-        new_token := await MongoDbClient().get_docs('reset_token').find_one({
+        new_token := await reset_token_service.db_client().find_one({
             "_id": create_result.inserted_id
         })
     ) is not None:
@@ -88,14 +102,14 @@ async def create_token(key: str, field_type: str, data = None):
 async def reset_password(token: str, data: ResetPassword):
     # Check token invalid
     if (
-        reset_token := await MongoDbClient().get_docs('reset_token').find_one({
+        reset_token := await reset_token_service.db_client().find_one({
             "token": token, "type": "PASSWORD", "status": True, "expired_time": {"$gte": datetime.utcnow()}
         })
     ) is None:
         raise HTTPException(status_code=400, detail=f"Reset token is invalid.")
     # Check user not exists
     if (
-        user := await MongoDbClient().get_docs('user').find_one({"_id": reset_token['user_id']})
+        user := await user_service.db_client().find_one({"_id": reset_token['user_id']})
     ) is None:
         raise HTTPException(status_code=400, detail=f"User {reset_token['user_id']} not found.")
     # Check confirm password matched password
@@ -103,14 +117,14 @@ async def reset_password(token: str, data: ResetPassword):
         raise HTTPException(status_code=400, detail="Password confirmed does not match.")
     # Hash password and update to user database
     hashed = pbkdf2_sha256.hash(data.password)
-    update_result = await MongoDbClient().get_docs('user').update_one(
+    update_result = await user_service.db_client().update_one(
         {"_id": user['_id']}, {"$set": { "password": hashed}}
     )
     if update_result.modified_count == 1:
         if (
             updated_user := await user_service.find({"_id": user['_id']})
         ) is not None:
-            MongoDbClient().get_docs('reset_token').update_one(
+            reset_token_service.db_client().update_one(
                 {"token": token}, {"$set": {"status": False}}
             )
             await user_service.cache_update(updated_user)
@@ -121,26 +135,29 @@ async def reset_password(token: str, data: ResetPassword):
 async def reset_email(token: str):
     # Check token invalid
     if (
-        reset_token := await MongoDbClient().get_docs('reset_token').find_one({
+        reset_token := await reset_token_service.db_client().find_one({
             "token": token, "type": "EMAIL", "status": True, "expired_time": {"$gte": datetime.utcnow()}
         })
     ) is None:
         raise HTTPException(status_code=400, detail=f"Reset token is invalid.")
     # Check user not exists
     if (
-        user := await MongoDbClient().get_docs('user').find_one({"_id": reset_token['user_id']})
+        user := await user_service.db_client().find_one({"_id": reset_token['user_id']})
     ) is None:
         raise HTTPException(status_code=400, detail=f"User {reset_token['user_id']} not found.")
 
     # Update result
-    update_result = await MongoDbClient().get_docs('user').update_one(
-        {"_id": user['_id']}, {"$set": { "email": reset_token['data']}}
+    update_result = await user_service.db_client().update_one(
+        {"_id": user['_id']}, {"$set": {
+            "email": reset_token['data'],
+            **{ f'_search.{k}': v for k, v in user_service.search_values({'email': reset_token['data']}, True).items() }
+        }}
     )
     if update_result.modified_count == 1:
         if (
             updated_user := await user_service.find({"_id": user['_id']})
         ) is not None:
-            MongoDbClient().get_docs('reset_token').update_one(
+            reset_token_service.db_client().update_one(
                 {"token": token}, {"$set": {"status": False}}
             )
             await user_service.cache_update(updated_user)
@@ -1,7 +1,9 @@
 import asyncio
 import sys
 import traceback
+from datetime import datetime, timedelta
 
+from bson import ObjectId
 from pytest_asyncio import fixture
 
 from _documents._base.schema import ServiceBaseConfig
@@ -59,3 +61,24 @@ async def user_service() -> UserService:
     await service.cache_clear()
     return service
 
+
+
+# Data
+@fixture
+def user_documents():
+    """
+    > Build user documents as stored in Mongo, without writing them
+    """
+    def build(n: int = 10000, logins: int = 1) -> List[dict]:
+        now = datetime.utcnow().replace(microsecond=0)
+        return [{
+            **User(
+                email=f'user{i}@example.com', name=f'User {i}', roles=['user'], status='active',
+                login_history=[{
+                    'timestamp': [now - timedelta(days=d, minutes=j) for d in range(5)],
+                    'ip_address': '127.0.0.1', 'user_agent': 'pytest'
+                } for j in range(logins)]
+            ).dict(),
+            '_id': ObjectId()
+        } for i in range(n)]
+    return build
@@ -1,16 +1,41 @@
 from _documents.logs.service import logging_service
 from _documents.notifications.service import notification_service
+from _documents.settings.service import setting_service
+from _documents.users.service import user_service
 
 
 JOB_SCHEDULE = [
     {
-        "func": logging_service.clean_up,
+        "func": logging_service.migrate_logs,
         "trigger": "cron",
         "day_of_week": "*",
         "hour": 0,
         "minute": 0,
-        "second": 0,
-        "args": [90]
+        "second": 0
+    },
+    {
+        "func": notification_service.migrate_inbox,
+        "trigger": "cron",
+        "day_of_week": "*",
+        "hour": 0,
+        "minute": 30,
+        "second": 0
+    },
+    {
+        "func": user_service.reindex_search,
+        "trigger": "cron",
+        "day_of_week": "*",
+        "hour": 1,
+        "minute": 0,
+        "second": 0
+    },
+    {
+        "func": setting_service.reindex_search,
+        "trigger": "cron",
+        "day_of_week": "*",
+        "hour": 1,
+        "minute": 0,
+        "second": 0
     },
     {
         "func": notification_service.clean_up,
@@ -10,8 +10,22 @@ FRONT_END_URL=os.environ.get("FRONT_END_URL")
 
 REDIS_URL=os.environ.get("REDIS_URL")
 
+REDIS_CODEC=os.environ.get("REDIS_CODEC", "json")
+REDIS_CODEC_MIGRATE_FROM=os.environ.get("REDIS_CODEC_MIGRATE_FROM")
+REDIS_MAX_CONNECTIONS=int(os.environ.get("REDIS_MAX_CONNECTIONS") or 50)
+REDIS_POOL_TIMEOUT=float(os.environ.get("REDIS_POOL_TIMEOUT") or 5) # seconds waiting for a free connection
+REDIS_SOCKET_TIMEOUT=float(os.environ.get("REDIS_SOCKET_TIMEOUT") or 5)
+REDIS_CONNECT_TIMEOUT=float(os.environ.get("REDIS_CONNECT_TIMEOUT") or 2)
+
 MONGODB_CONN_STR=os.environ.get("MONGODB_CONN_STR")
 
+MONGODB_MAX_POOL_SIZE=int(os.environ.get("MONGODB_MAX_POOL_SIZE") or 100)
+MONGODB_MIN_POOL_SIZE=int(os.environ.get("MONGODB_MIN_POOL_SIZE") or 0)
+MONGODB_MAX_IDLE_TIME_MS=int(os.environ.get("MONGODB_MAX_IDLE_TIME_MS") or 0) or None
+MONGODB_WAIT_QUEUE_TIMEOUT_MS=int(os.environ.get("MONGODB_WAIT_QUEUE_TIMEOUT_MS") or 0) or None
+MONGODB_COMPRESSORS=os.environ.get("MONGODB_COMPRESSORS") # e.g. "zstd,snappy,zlib"
+MONGODB_SECONDARY_READS=(os.environ.get("MONGODB_SECONDARY_READS") or "logs log_actions log_rollups").split(" ")
+
 PAYPAL_CLIENT_ID=os.environ.get("PAYPAL_CLIENT_ID")
 
 PAYPAL_SECRET=os.environ.get("PAYPAL_SECRET")
@@ -30,6 +44,8 @@ MAIL_SERVER=os.environ.get("MAIL_SERVER")
 DO_SPACES_KEY=os.environ.get("DO_SPACES_KEY")
 DO_SPACES_SECRET=os.environ.get("DO_SPACES_SECRET")
 
+CACHE_WARM_UP=True if os.environ.get("CACHE_WARM_UP") == "active" else False
+
 CORS_ORIGINS=os.environ.get("CORS_ORIGINS") if os.environ.get("CORS_ORIGINS") is not None else ""
 
 # App Variables
@@ -41,6 +57,8 @@ API_ALGORITHM='HS256'
 
 API_ACCESS_TOKEN_EXPIRE_MINUTES=10080
 
+OAUTH_STATE_TTL=600 # seconds a Google login has to come back with its state
+
 HOST="0.0.0.0"
 
 PORT=8000
@@ -51,6 +69,56 @@ MAX_QUERY_LENGTH=10000
 
 MAX_FETCH_LIMIT = 200
 
+ITER_BATCH_SIZE = 1000
+
+SEARCH_TOKEN_LENGTH = 16
+
+SEARCH_VERSION = 1 # bump when `search_tokens` changes, the documents are reindexed by the cron
+
+SEARCH_REINDEX_LOCK_MS = 3600 * 1000
+
+REDIS_SCAN_COUNT = 1000
+
+LOCAL_CACHE_SIZE = 10000
+
+LOCAL_CACHE_TTL = 60
+
+LOCAL_CACHE_CHANNEL = '_cache:invalidate'
+
+COUNT_CACHE_TTL = 30
+
+MEMOIZE_TTL = 60
+
+MEMOIZE_TAG_TTL = 86400 # the longest TTL of a memoized result
+
+CACHE_VERSION = 1
+
+CACHE_TTL = 3600
+
+CACHE_WARM_UP_DAYS = 7
+
+CACHE_TTL_JITTER = 0.1
+
+NEGATIVE_CACHE_TTL = 30
+
+CACHE_LOCK_TIMEOUT_MS = 2000
+
+CACHE_LOCK_POLL_MS = 50
+
+LOG_QUEUE_SIZE = 10000
+
+LOG_BATCH_SIZE = 500
+
+LOG_FLUSH_INTERVAL_MS = 1000
+
+LOG_RETENTION_DAYS = 90
+
+LOG_ROLLUP_RETENTION_DAYS = 365
+
+LOG_MIGRATION_LEASE = 600 # seconds a process keeps a day document it migrates
+
+LOG_BODY_MAX_SIZE = 100 # bytes, larger request bodies are not logged
+
 DATE_STR_FORMAT='%Y-%m-%d'
 
 FULL_DATE_STR_FORMAT = "%b %d, %Y %H:%M:%S"
@@ -1,3 +1,4 @@
+import asyncio
 import warnings
 
 import uvicorn
@@ -5,15 +6,18 @@ from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse
 
+from _documents.logs.service import logging_service
 from _services.mongo.client import MongoDbClient
+from _services.redis.service import RedisClient
 from api.app import api_app, shutdown_api, startup_api
 from auth.app import auth_app, startup_auth
 from config.settings import *
-from setup.service import load_dataset
+from setup.service import (drop_stale_caches, load_dataset,
+                           migrate_cache_codec, sync_indexes, warm_up_cache)
 from stream.app import startup_stream, stream_app
 from webhooks.app import webhooks_app
 
-# from setup.service import load_dataset
+# from setup.service import load_dataset, sync_indexes
 warnings.filterwarnings("ignore")
 
 app = FastAPI()
@@ -33,15 +37,24 @@ app.add_middleware(
 
 @app.on_event("startup")
 async def startup():
+    await MongoDbClient().startup()
     # await load_dataset()
+    await sync_indexes()
+    if REDIS_CODEC_MIGRATE_FROM: await migrate_cache_codec()
+    if CACHE_WARM_UP: await warm_up_cache()
+    # Stale cache namespaces are dropped in the background, the new ones are keyed apart
+    app.state.drop_stale_task = asyncio.create_task(drop_stale_caches())
     await startup_auth()
     await startup_api()
     startup_stream()
+    logging_service.start()
 
 @app.on_event("shutdown")
 async def shutdown():
-    MongoDbClient().disconnect()
     await shutdown_api()
+    await logging_service.stop()
+    MongoDbClient().shutdown()
+    await RedisClient().shutdown()
 
 @app.get('/')
 async def root():
@@ -1,10 +1,17 @@
 import json
+from datetime import datetime, timedelta
 from pathlib import Path
 from typing import List, Dict
 from pydantic import BaseModel
-from config.settings import MAX_QUERY_LENGTH
+from config.settings import CACHE_WARM_UP_DAYS, DEBUG_MODE, MAX_QUERY_LENGTH, REDIS_CODEC_MIGRATE_FROM
 from _services.mongo.client import MongoDbClient
+from _services.redis.service import RedisClient
+from _documents.logs.service import logging_service
+from _documents.notifications.service import notification_service
 from _documents.settings.schema import Setting
+from _documents.settings.service import setting_service
+from _documents.users.service import user_service
+from auth.reset_token.service import reset_token_service
 
 from utils.logger import logger
 
@@ -75,3 +82,51 @@ async def load_dataset():
         logger.info(f"load_dataset {x['document']} installation : {x['inserted']} / {x['total']} records have been inserted.")
     
     return
+
+
+async def sync_indexes():
+    for service in [
+        user_service, setting_service, notification_service, logging_service, reset_token_service
+    ]:
+        try:
+            await service.sync_indexes()
+        except Exception as e:
+            logger.error(f"[Index] Unable to sync indexes of {service.config.document}: {e}")
+    if DEBUG_MODE:
+        await MongoDbClient().profile_collscans()
+
+
+async def migrate_cache_codec():
+    # Only the records of the services, the other keys of the Redis are not ours to rewrite
+    migrated = await RedisClient().migrate_codec(REDIS_CODEC_MIGRATE_FROM, [
+        f'{service.config.document}:*' for service in [
+            user_service, setting_service, notification_service, logging_service
+        ]
+    ])
+    logger.info(f"[Cache] Migrated {migrated} Redis keys from the {REDIS_CODEC_MIGRATE_FROM} codec")
+
+
+async def drop_stale_caches():
+    for service in [
+        user_service, setting_service, notification_service, logging_service
+    ]:
+        try:
+            if (deleted := await service.cache_drop_stale()) > 0:
+                logger.info(f"[Cache] Dropped {deleted} stale records of {service.config.document}")
+        except Exception as e:
+            logger.error(f"[Cache] Unable to drop the stale records of {service.config.document}: {e}")
+
+
+async def warm_up_cache():
+    for service, query in [
+        (user_service, {
+            'status': 'active',
+            'login_history.timestamp': {'$gte': datetime.utcnow() - timedelta(days=CACHE_WARM_UP_DAYS)}
+        }),
+        (setting_service, {}),
+    ]:
+        try:
+            cached = await service.cache_warm_up(query)
+            logger.info(f"[Cache] Preloaded {cached} records of {service.config.document}")
+        except Exception as e:
+            logger.error(f"[Cache] Unable to preload {service.config.document}: {e}")
@@ -9,7 +9,8 @@ class RoleGuard:
     def __init__(self, allowed_roles: List[str]):
         self.allowed_roles = allowed_roles
 
-    def __call__(self, user: UserList = Depends(user_service.parse_token_bearer)):
+    def __call__(self, user: UserList = Depends(user_service.parse_token_access)):
+        # Only the roles and status of the user are loaded
         if user.status == 'PENDING':
             raise HTTPException(status_code=401, detail="Your email has not been verified.")
         elif user.status == 'LOCKED':
@@ -8,6 +8,7 @@ import numpy as np
 from bson import ObjectId
 from ordered_set import OrderedSet
 from pydantic import AnyUrl, BaseModel, EmailStr, Field
+from pydantic.json import pydantic_encoder
 
 DATABASE_TYPES = {
     'Boolean': lambda x: True if str(x).lower() == 'true' else 'false',
@@ -61,6 +62,31 @@ class BaseConfig():
         np.int64: int
     }
 
+
+def json_encoder(encoders: dict = BaseConfig.json_encoders):
+    """
+    > Compile a function that encodes a value into JSON-ready python objects with the given
+    encoders, the result is the same as `json.loads(model.json())` without the dump and parse
+    
+    :param encoders: The encoders by type, defaults to `BaseConfig.json_encoders`
+    :type encoders: dict
+    :return: The encode function
+    """
+    primary_types = (str, int, float, bool, type(None))
+
+    def encode(value):
+        if isinstance(value, dict): return {str(k): encode(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple, set)): return [encode(v) for v in value]
+        if (encoder := encoders.get(type(value))) is not None: return encoder(value)
+        if isinstance(value, primary_types): return value
+        for t, encoder in encoders.items():
+            if isinstance(value, t): return encoder(value)
+        return encode(pydantic_encoder(value))
+    return encode
+
+
+encode_json = json_encoder()
+
 class UserActivity(BaseModel):
     user: PyObjectId | str
     time: datetime = Field(default_factory=datetime.utcnow)